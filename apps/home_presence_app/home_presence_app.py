@@ -18,10 +18,27 @@ apps.yaml parameters:
 """
 import json
 import adbase as ad
-import copy
+import bisect
+from collections import Counter, deque
 from datetime import datetime, timedelta
-import traceback
+import functools
+import logging
+import logging.handlers
+import os
 import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+try:
+    # faster decoding of the JSON payloads, if installed
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 
 __VERSION__ = "2.4.2"
@@ -29,11 +46,752 @@ IGNORED_ACTIONS = [
     "depart",
     "arrive",
     "state",
+    "command_result",
+    "performance",
+]
+
+# Setup instructions sent by the app, which the nodes acknowledge
+SETUP_ACTIONS = [
     "known device states",
     "add static device",
     "delete static device",
 ]
 
+# Steps of provisioning the nodes, with the action acknowledging each step
+PROVISIONING_ACKS = {
+    "discovering": "status",
+    "removing": "delete static device",
+    "restarting": "status",
+    "loading": "loaded",
+    "syncing": "known device states",
+}
+
+# Bound on the number of parsed topics kept by the message router
+TOPIC_CACHE_SIZE = 2048
+
+# Order scans waiting for the nodes to be idle are sent in, lowest first
+SCAN_PRIORITIES = {"arrive": 0, "rssi": 1, "depart": 2}
+
+# Bound on the output of a node command kept in memory, in bytes
+COMMAND_OUTPUT_SIZE = 16384
+
+# Upper bounds of the buckets of the latency histograms, in milliseconds
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000)
+
+# Callbacks of the app timed when performance stats are enabled
+TIMED_CALLBACKS = (
+    "confidence_updated",
+    "update_hass_sensor",
+    "flush_hass_writes",
+    "forward_monitor_state",
+)
+
+
+class MessageRoute:
+    """A monitor topic template, parsed once, and the handler for its action.
+
+    Templates are relative to the monitor topic, for example
+    ``{location}/{device}/rssi``. Named segments are extracted positionally
+    from incoming topics, the last segment being the action.
+    """
+
+    __slots__ = ("action", "template", "fields", "handler", "decode_json")
+
+    def __init__(self, action, template, handler, decode_json=False):
+        self.action = action
+        self.template = template
+        self.fields = tuple(
+            (index, segment[1:-1])
+            for index, segment in enumerate(template.split("/"))
+            if segment.startswith("{") and segment.endswith("}")
+        )
+        self.handler = handler
+        self.decode_json = decode_json
+
+    def match(self, topic_path):
+        """Extract the named fields of the template from a relative topic path."""
+        fields = {"action": self.action}
+        for index, name in self.fields:
+            if name == "location":
+                # the location is only valid if it is not the action itself
+                value = topic_path[index] if len(topic_path) > index + 1 else None
+            else:
+                value = topic_path[index] if len(topic_path) > index else None
+
+            fields[name] = value
+
+        return fields
+
+
+class EntityRecord:
+    """The last state and attributes the app knows a HASS entity to have."""
+
+    __slots__ = ("entity_id", "state", "attributes", "exists")
+
+    def __init__(self, entity_id):
+        self.entity_id = entity_id
+        self.state = None
+        self.attributes = {}
+        self.exists = False
+
+    def load(self, entity_state):
+        """Load the record from the full state of the entity."""
+        self.state = entity_state.get("state")
+        self.attributes = dict(entity_state.get("attributes", {}))
+        self.exists = True
+
+    def forget(self):
+        """Forget the state, as the entity might no longer exist."""
+        self.state = None
+        self.attributes = {}
+        self.exists = False
+
+
+class DeviceRecord(EntityRecord):
+    """A tracked device, and its home state sensor."""
+
+    __slots__ = (
+        "device_name",
+        "device_entity_id",
+        "locations",
+        "handle",
+        "mqtt_exists",
+        "rssi",
+        "nearest",
+        "confidence",
+        "above",
+        "max_confidence",
+        "presence",
+        "tracked",
+        "mac",
+        "name",
+    )
+
+    def __init__(self, device_name, device_entity_id, state_sensor):
+        super().__init__(state_sensor)
+        self.device_name = device_name
+        self.device_entity_id = device_entity_id
+        self.locations = dict()
+        self.handle = None
+        self.mqtt_exists = False
+        self.rssi = dict()
+        self.nearest = None
+        self.confidence = dict()
+        self.above = 0
+        self.max_confidence = 0
+        self.presence = None
+        self.tracked = False
+        self.mac = None
+        self.name = None
+
+    def active_records(self):
+        """Location records that reported the device since the app started."""
+        return [
+            record for record in self.locations.values() if record.handle is not None
+        ]
+
+    def update_confidence(self, location, confidence, minimum):
+        """Update the confidence reported by a location, and the aggregates.
+
+        The aggregates are the number of locations at or above the minimum
+        confidence, and the highest confidence reported by any location.
+        """
+        previous = self.confidence.get(location)
+        self.confidence[location] = confidence
+
+        if previous is not None and previous >= minimum:
+            self.above -= 1
+
+        if confidence >= minimum:
+            self.above += 1
+
+        if confidence >= self.max_confidence:
+            self.max_confidence = confidence
+
+        elif previous == self.max_confidence:
+            # the location with the highest confidence dropped
+            self.max_confidence = max(self.confidence.values())
+
+    def update_rssi(self, location, rssi, margin=0):
+        """Update the RSSI reported by a location, and the nearest location.
+
+        Another location only becomes the nearest, if its RSSI is higher than
+        that of the nearest location by more than the margin.
+        """
+        try:
+            rssi = int(float(rssi))
+        except (TypeError, ValueError):
+            rssi = None
+
+        previous = self.rssi.pop(location, None)
+        if rssi is None:
+            if location == self.nearest:
+                # the nearest location lost the device, so use the next nearest
+                self.nearest = max(self.rssi, key=self.rssi.get, default=None)
+            return
+
+        self.rssi[location] = rssi
+        if self.nearest is None:
+            self.nearest = location
+
+        elif location != self.nearest:
+            if rssi > self.rssi[self.nearest] + margin:
+                self.nearest = location
+
+        elif previous is not None and rssi < previous:
+            # the nearest location reports the device further, so check the others
+            others = (loc for loc in self.rssi if loc != location)
+            challenger = max(others, key=self.rssi.get, default=None)
+            if challenger is not None and self.rssi[challenger] > rssi + margin:
+                self.nearest = challenger
+
+
+class LocationRecord(EntityRecord):
+    """A device as seen by a location, and its confidence sensor."""
+
+    __slots__ = ("device", "location", "appdaemon_entity", "handle")
+
+    def __init__(self, device, location, conf_sensor, appdaemon_entity):
+        super().__init__(conf_sensor)
+        self.device = device
+        self.location = location
+        self.appdaemon_entity = appdaemon_entity
+        self.handle = None
+
+
+class PresenceRegistry:
+    """In-memory registry of the devices and locations tracked by the app.
+
+    Records are keyed by (device, location), and own the names of the
+    entities generated for them, alongside the last state and attributes
+    written to HASS, so the hot path need not query the state store.
+
+    The occupancy of the home is kept as counters of the tracked devices
+    that are home, away or unknown, updated as their presence changes.
+    """
+
+    def __init__(self, monitor_name, user_device_domain, state_true, state_false):
+        self.monitor_name = monitor_name
+        self.user_device_domain = user_device_domain
+        self.state_true = state_true
+        self.state_false = state_false
+        self.devices = dict()
+        self.records = dict()
+        self.entities = dict()
+        self.locations = dict()
+        self.macs = dict()
+        self.home = 0
+        self.away = 0
+        self.unknown = 0
+
+    def get_device(self, device_name):
+        """Get the record of a device."""
+        return self.devices.get(device_name)
+
+    def add_device(self, device_name):
+        """Get the record of a device, adding it if not yet known."""
+        device = self.devices.get(device_name)
+        if device is None:
+            device_entity_id = f"{self.monitor_name}_{device_name}"
+            device = DeviceRecord(
+                device_name,
+                device_entity_id,
+                f"{self.user_device_domain}.{device_entity_id}",
+            )
+            self.devices[device_name] = device
+            self.entities[device.entity_id] = device
+
+        return device
+
+    def add_entity(self, entity_id):
+        """Get the record of another HASS entity owned by the app."""
+        record = self.entities.get(entity_id)
+        if record is None:
+            record = EntityRecord(entity_id)
+            self.entities[entity_id] = record
+
+        return record
+
+    def set_presence(self, device, presence):
+        """Set if a device is home or not, and count it in the occupancy.
+
+        Returns True if the presence of the device changed.
+        """
+        if device.tracked:
+            if device.presence == presence:
+                return False
+
+            self.count_presence(device.presence, -1)
+
+        device.presence = presence
+        device.tracked = True
+        self.count_presence(presence, 1)
+        return True
+
+    def count_presence(self, presence, step):
+        """Add a step to the occupancy counter of a presence."""
+        if presence == self.state_true:
+            self.home += step
+
+        elif presence == self.state_false:
+            self.away += step
+
+        else:
+            self.unknown += step
+
+    def get(self, device_name, location):
+        """Get the record of a device in a location."""
+        return self.records.get((device_name, location))
+
+    def add(self, device_name, location):
+        """Get the record of a device in a location, adding it if not yet known."""
+        record = self.records.get((device_name, location))
+        if record is None:
+            device = self.add_device(device_name)
+            record = LocationRecord(
+                device,
+                location,
+                f"sensor.{device.device_entity_id}_{location}_conf",
+                f"{self.monitor_name}.{device_name}_{location}",
+            )
+            device.locations[location] = record
+            self.records[(device_name, location)] = record
+            self.entities[record.entity_id] = record
+            self.locations.setdefault(location, dict())[device_name] = record
+
+        return record
+
+    def set_identity(self, device, mac, name=None):
+        """Set the MAC address and name reported for a device, and index it."""
+        if mac is not None and mac != device.mac:
+            if device.mac is not None:
+                self.macs.get(device.mac, set()).discard(device.device_name)
+
+            device.mac = mac
+            self.macs.setdefault(mac, set()).add(device.device_name)
+
+        if name is not None:
+            device.name = name
+
+    def mac_devices(self, mac):
+        """Get the records of the devices with a MAC address."""
+        return [
+            self.devices[device_name]
+            for device_name in self.macs.get(mac, ())
+            if device_name in self.devices
+        ]
+
+    def location_records(self, location):
+        """Get the records of all devices seen by a location."""
+        return list(self.locations.get(location, {}).values())
+
+    def remove_device(self, device_name):
+        """Remove a device and all its location records."""
+        device = self.devices.pop(device_name, None)
+        if device is None:
+            return None
+
+        if device.tracked:
+            self.count_presence(device.presence, -1)
+
+        if device.mac is not None:
+            device_names = self.macs.get(device.mac, set())
+            device_names.discard(device_name)
+            if not device_names:
+                self.macs.pop(device.mac, None)
+
+        self.entities.pop(device.entity_id, None)
+        for location, record in device.locations.items():
+            self.records.pop((device_name, location), None)
+            self.entities.pop(record.entity_id, None)
+            self.locations.get(location, {}).pop(device_name, None)
+
+        return device
+
+    def forget_hass_state(self):
+        """Forget all HASS state known, as HASS no longer has the entities."""
+        for record in self.entities.values():
+            record.forget()
+
+
+class SSHPool:
+    """Persistent SSH connections to the nodes, shared by the executor threads.
+
+    A connection is opened the first time a node is used, kept alive and
+    reused for later commands, and reopened if it dropped. Each node allows
+    a bounded number of commands to run at once.
+    """
+
+    def __init__(self, settings, connect_timeout, keepalive, max_channels):
+        self.settings = settings
+        self.connect_timeout = connect_timeout
+        self.keepalive = keepalive
+        self.max_channels = max_channels
+        self.lock = threading.Lock()
+        self.clients = dict()
+        self.channels = dict()
+        self.connecting = dict()
+        self.in_use = dict()
+        self.last_used = dict()
+        self.stats = dict()
+
+    def node_stats(self, node):
+        """Get the connection stats of a node."""
+        return self.stats.setdefault(node, {"connects": 0, "reuses": 0, "failures": 0})
+
+    def connect(self, node):
+        """Get the node's connection, opening it if need be."""
+        client = self.clients.get(node)
+        transport = client.get_transport() if client is not None else None
+        if transport is not None and transport.is_active():
+            self.node_stats(node)["reuses"] += 1
+            return client
+
+        import paramiko
+
+        if client is not None:
+            client.close()
+
+        setting = self.settings[node]
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(
+            setting["host"],
+            username=setting["username"],
+            password=setting["password"],
+            timeout=self.connect_timeout,
+        )
+        client.get_transport().set_keepalive(self.keepalive)
+
+        self.clients[node] = client
+        self.node_stats(node)["connects"] += 1
+        return client
+
+    def execute(self, node, cmd, timeout=None, on_output=None):
+        """Run a command on a node, and return its result.
+
+        The output is read as it arrives, and passed to on_output with the
+        stream it came from if given. The command is stopped if it runs for
+        longer than timeout seconds.
+        """
+        with self.lock:
+            if node not in self.channels:
+                self.channels[node] = threading.BoundedSemaphore(self.max_channels)
+                self.connecting[node] = threading.Lock()
+
+            channels = self.channels[node]
+            connecting = self.connecting[node]
+
+        with channels:
+            with self.lock:
+                self.in_use[node] = self.in_use.get(node, 0) + 1
+
+            failed = False
+            try:
+                # connect outside of the pool lock, so nodes connect in parallel
+                with connecting:
+                    client = self.connect(node)
+
+                stdin, stdout, stderr = client.exec_command(cmd, timeout=timeout)
+                return self.read_output(stdout.channel, timeout, on_output)
+
+            except Exception:
+                failed = True
+                raise
+
+            finally:
+                with self.lock:
+                    self.in_use[node] -= 1
+                    self.last_used[node] = time.monotonic()
+                    if failed:
+                        self.node_stats(node)["failures"] += 1
+                        self.close(node)
+
+    def read_output(self, channel, timeout, on_output):
+        """Read a command's output from its channel, until it exits."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        output = {"stdout": bytearray(), "stderr": bytearray()}
+        timed_out = False
+
+        while True:
+            if channel.recv_ready():
+                stream, data = "stdout", channel.recv(4096)
+            elif channel.recv_stderr_ready():
+                stream, data = "stderr", channel.recv_stderr(4096)
+            elif channel.exit_status_ready():
+                break
+            elif deadline is not None and time.monotonic() > deadline:
+                timed_out = True
+                channel.close()
+                break
+            else:
+                time.sleep(0.05)
+                continue
+
+            if on_output is not None:
+                on_output(stream, data.decode(errors="replace"))
+
+            # only the tail of the output is kept
+            output[stream] += data
+            del output[stream][:-COMMAND_OUTPUT_SIZE]
+
+        return {
+            "exit_code": None if timed_out else channel.recv_exit_status(),
+            "timed_out": timed_out,
+            "stdout": output["stdout"].decode(errors="replace").splitlines(),
+            "stderr": output["stderr"].decode(errors="replace").splitlines(),
+        }
+
+    def close(self, node):
+        """Close the node's connection, if no command is using it."""
+        if self.in_use.get(node, 0) > 0:
+            return
+
+        client = self.clients.pop(node, None)
+        if client is not None:
+            client.close()
+
+    def evict_idle(self, idle_time):
+        """Close the connections not used for idle_time seconds."""
+        now = time.monotonic()
+        with self.lock:
+            for node in list(self.clients):
+                if now - self.last_used.get(node, now) >= idle_time:
+                    self.close(node)
+
+    def close_all(self):
+        """Close all connections."""
+        with self.lock:
+            for node in list(self.clients):
+                self.close(node)
+
+
+class LatencyHistogram:
+    """Counts of latencies in the LATENCY_BUCKETS, in milliseconds."""
+
+    __slots__ = ("counts", "total", "maximum")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, latency):
+        """Count a latency."""
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        self.total += latency
+        if latency > self.maximum:
+            self.maximum = latency
+
+    def percentile(self, percentile):
+        """Get the upper bound of the bucket a percentile of latencies is in."""
+        rank = sum(self.counts) * percentile / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if index < len(LATENCY_BUCKETS):
+                    return min(LATENCY_BUCKETS[index], self.maximum)
+                break
+
+        return self.maximum
+
+    def summary(self):
+        """Get the count, mean, percentiles and max of the latencies."""
+        count = sum(self.counts)
+        return {
+            "count": count,
+            "mean": round(self.total / count, 3) if count else 0,
+            "p50": round(self.percentile(50), 3),
+            "p95": round(self.percentile(95), 3),
+            "p99": round(self.percentile(99), 3),
+            "max": round(self.maximum, 3),
+        }
+
+
+class PerformanceStats:
+    """Counters and latency histograms of the hot paths of the app.
+
+    The instrumented callables are wrapped only when the stats are enabled,
+    so nothing is added to them otherwise. The stats are kept for an
+    interval, then reported and started over.
+    """
+
+    def __init__(self):
+        self.total_messages = 0
+        self.reset()
+
+    def reset(self):
+        """Start the stats of a new interval."""
+        self.since = time.monotonic()
+        self.actions = dict()
+        self.callbacks = dict()
+        self.messages = 0
+        self.store_calls = 0
+        self.message_store_calls = 0
+        self.timers_started = 0
+        self.timers_cancelled = 0
+
+    def time_messages(self, handler, get_action):
+        """Wrap the handler of the MQTT messages, timing each action."""
+
+        @functools.wraps(handler)
+        def timed(event_name, data, kwargs):
+            store_calls = self.store_calls
+            start = time.perf_counter()
+            try:
+                return handler(event_name, data, kwargs)
+            finally:
+                latency = (time.perf_counter() - start) * 1000
+                self.record(self.actions, get_action(data.get("topic")), latency)
+                self.messages += 1
+                self.total_messages += 1
+                self.message_store_calls += self.store_calls - store_calls
+
+        return timed
+
+    def time_callback(self, name, callback):
+        """Wrap a callback, timing each call."""
+
+        @functools.wraps(callback)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return callback(*args, **kwargs)
+            finally:
+                latency = (time.perf_counter() - start) * 1000
+                self.record(self.callbacks, name, latency)
+
+        return timed
+
+    @staticmethod
+    def record(histograms, name, latency):
+        """Add a latency to the histogram of a name."""
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = LatencyHistogram()
+
+        histogram.add(latency)
+
+    def count_calls(self, counter, func):
+        """Wrap a function, counting its calls on a counter attribute."""
+
+        @functools.wraps(func)
+        def counted(*args, **kwargs):
+            setattr(self, counter, getattr(self, counter) + 1)
+            return func(*args, **kwargs)
+
+        return counted
+
+    def report(self):
+        """Get the stats of the interval, as the state and its attributes."""
+        elapsed = max(time.monotonic() - self.since, 1)
+        rate = round(self.messages / elapsed, 2)
+        attributes = {
+            "messages": self.messages,
+            "total_messages": self.total_messages,
+            "messages_per_second": rate,
+            "actions": {
+                action: histogram.summary()
+                for action, histogram in sorted(self.actions.items())
+            },
+            "callbacks": {
+                name: histogram.summary()
+                for name, histogram in sorted(self.callbacks.items())
+            },
+            "store_calls": self.store_calls,
+            "store_calls_per_message": round(
+                self.message_store_calls / self.messages, 2
+            )
+            if self.messages
+            else 0,
+            "timers_started": self.timers_started,
+            "timers_cancelled": self.timers_cancelled,
+            "timers_per_minute": round(
+                (self.timers_started + self.timers_cancelled) * 60 / elapsed, 2
+            ),
+            "interval": round(elapsed, 1),
+        }
+        return rate, attributes
+
+
+class SamplingProfiler:
+    """Sampling profiler of the app's code, in whichever thread it runs.
+
+    The stacks of all threads are sampled at an interval. Of those running
+    the app, the frames from the outermost call into this module inwards are
+    counted, so what the app calls is seen, but not AppDaemon dispatching
+    the callbacks.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.rounds = 0
+        self.samples = 0
+        self.elapsed = 0.0
+        self.self_counts = Counter()
+        self.cumulative_counts = Counter()
+
+    def run(self, duration):
+        """Sample the threads for a number of seconds."""
+        own_thread = threading.get_ident()
+        started = time.perf_counter()
+        while time.perf_counter() - started < duration:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_thread:
+                    self.sample(frame)
+
+            self.rounds += 1
+            time.sleep(self.interval)
+
+        self.elapsed = time.perf_counter() - started
+
+    def sample(self, frame):
+        """Count the functions of a thread's stack, if it is running the app."""
+        stack = []
+        outermost = 0
+        while frame is not None:
+            stack.append(frame.f_code)
+            if frame.f_code.co_filename == __file__:
+                outermost = len(stack)
+
+            frame = frame.f_back
+
+        if not outermost:
+            return
+
+        self.samples += 1
+        self.self_counts[stack[0]] += 1
+        self.cumulative_counts.update(set(stack[:outermost]))
+
+    def top(self, count):
+        """Get the functions with the most cumulative time, in seconds."""
+        period = self.elapsed / self.rounds if self.rounds else 0
+        return [
+            {
+                "function": f"{os.path.basename(code.co_filename)}:"
+                f"{code.co_firstlineno}({code.co_name})",
+                "cumulative": round(samples * period, 3),
+                "self": round(self.self_counts[code] * period, 3),
+            }
+            for code, samples in self.cumulative_counts.most_common(count)
+        ]
+
+    def report(self):
+        """Get the report of all the functions sampled, as text."""
+        lines = [
+            f"Sampled for {self.elapsed:.1f}s every {self.interval * 1000:g} ms,"
+            f" {self.samples} samples of the app running in {self.rounds} rounds",
+            "",
+            f"{'cumulative s':>12}  {'self s':>8}  function",
+        ]
+        lines.extend(
+            f"{entry['cumulative']:>12.3f}  {entry['self']:>8.3f}  {entry['function']}"
+            for entry in self.top(None)
+        )
+        return "\n".join(lines) + "\n"
+
+
 # pylint: disable=attribute-defined-outside-init,unused-argument
 class HomePresenceApp(ad.ADBase):
     """Home Precence App Main Class."""
@@ -44,6 +802,11 @@ class HomePresenceApp(ad.ADBase):
         self.hass = self.get_plugin_api("HASS")
         self.mqtt = self.get_plugin_api("MQTT")
 
+        # instrument the app before any of its callbacks are registered
+        self.performance = None
+        if self.args.get("performance_stats", False):
+            self.setup_performance_stats()
+
         self.monitor_topic = self.args.get("monitor_topic", "monitor")
         self.user_device_domain = self.args.get("user_device_domain", "binary_sensor")
 
@@ -74,16 +837,68 @@ class HomePresenceApp(ad.ADBase):
         self.depart_check_time = self.args.get("depart_check_time", 30)
         self.system_timeout = self.args.get("system_timeout", 60)
         system_check = self.args.get("system_check", 30)
+        self.system_check = system_check
+        self.write_window = float(self.args.get("hass_write_window", 0.25))
+        self.state_delta = self.args.get("state_forwarding", "full") == "delta"
+        self.forward_window = float(self.args.get("state_forward_window", 1))
+        forward_snapshot_interval = self.args.get("state_snapshot_interval", 300)
+        self.nearest_monitor_margin = self.args.get("nearest_monitor_margin", 0)
 
-        self.all_users_sensors = list()
         self.not_home_timers = dict()
         self.location_timers = dict()
-        self.confidence_handlers = dict()
-        self.home_state_entities = dict()
         self.system_handle = dict()
         self.node_scheduled_reboot = dict()
         self.node_executing = dict()
+        self.node_commands = dict()
+        self.node_rebooting = set()
+        self.command_lock = threading.Lock()
+
+        # echoes sent to the nodes, and the round trip times of their replies
+        self.echo_seq = 0
+        self.echo_sent = dict()
+        self.echo_answered = dict()
+        self.echo_rtts = dict()
+        self.echo_reported = dict()
+
+        # last result of probing each node's reachability, and nodes being probed
+        self.reachability = dict()
+        self.probing = set()
         self.locations = set()
+        self.node_states = dict()
+
+        # MAC addresses of the devices each node reported, and devices being
+        # loaded to each node
+        self.node_devices = dict()
+        self.device_loaders = dict()
+
+        # Provisioning of the nodes, started by clean_devices
+        self.provision_step = None
+        self.provision_acks = dict()
+        self.provision_timer = None
+        self.provision_started = None
+        self.provision_removed = []
+        self.provision_queue = []
+
+        self.profiling = False
+
+        # write the messages received to a file, to replay them later
+        self.capture = None
+        if self.args.get("capture_file") is not None:
+            self.setup_capture(self.args["capture_file"])
+
+        # HASS sensor writes waiting for the write window to elapse
+        self.pending_writes = dict()
+        self.write_timer = None
+        self.flushed_writes = 0
+        self.suppressed_writes = 0
+        self.reported_write_stats = None
+
+        # Monitor states waiting to be forwarded to MQTT, and the states last
+        # forwarded, which deltas are made against, and last retained
+        self.forward_states = dict()
+        self.forwarded_states = dict()
+        self.retained_states = dict()
+        self.forward_timer = None
 
         # Create a sensor to keep track of if the monitor is busy or not.
         self.monitor_entity = f"{self.monitor_name}.monitor_state"
@@ -97,6 +912,9 @@ class HomePresenceApp(ad.ADBase):
                 "nodes": 0,
                 "online_nodes": [],
                 "offline_nodes": [],
+                "flushed_writes": 0,
+                "suppressed_writes": 0,
+                "scan_queue": 0,
                 "friendly_name": "Monitor System State",
             },
             replace=True,
@@ -113,7 +931,11 @@ class HomePresenceApp(ad.ADBase):
             immediate=True,
         )
 
-        self.monitor_handlers = {self.monitor_entity: None}
+        # Setup the registry of devices, from the entities AD already has
+        self.registry = PresenceRegistry(
+            self.monitor_name, self.user_device_domain, self.state_true, self.state_false
+        )
+        self.load_registry()
 
         # Setup the Everybody Home/Not Home Group Sensors
         self.setup_global_sensors()
@@ -121,7 +943,34 @@ class HomePresenceApp(ad.ADBase):
         # Initialize our timer variables
         self.gateway_timer = None
         self.motion_timer = None
-        self.check_home_timer = None
+        self.scan_timer = None
+        self.next_scan = None
+
+        # scans waiting for the nodes to be idle, by scan type and location,
+        # with None for all locations
+        self.scan_queue = dict()
+        self.scan_queue_reported = 0
+        self.scan_guard = None
+        self.scan_sent = dict()
+        self.scanning_since = dict()
+        self.depart_timers = dict()
+        self.scans_dispatched = 0
+        self.scan_wait_total = 0.0
+
+        # rooms with motion waiting for a RSSI scan, by when motion was first
+        # seen, with None for all nodes, and the scans the rate limit allows
+        self.rssi_rooms = dict()
+        self.rssi_tokens = float(self.args.get("rssi_scan_burst", 3))
+        self.rssi_refilled = time.monotonic()
+        self.motion_sensor_times = dict()
+
+        # when arrivals and departures happen by hour of day, and motion and
+        # them were last seen, used to adapt the scan interval without gateway
+        # sensors
+        self.presence_history = [0.0] * 24
+        self.last_motion = None
+        self.last_presence_change = None
+        self.scan_times = deque()
 
         # Setup home gateway sensors
         if self.args.get("home_gateway_sensors") is not None:
@@ -132,27 +981,34 @@ class HomePresenceApp(ad.ADBase):
                     self.gateway_opened, sensor, namespace=namespace
                 )
         else:
-            # no gateway sensors, do app has to run arrive and depart scans every 2 minutes
+            # no gateway sensors, so app has to run arrive and depart scans by itself
+            self.scan_interval_min = self.args.get("scan_interval_min", 60)
+            self.scan_interval_max = self.args.get("scan_interval_max", 600)
             self.adapi.log(
-                "No Gateway Sensors specified, Monitor-APP will run Arrive and Depart Scan every 2 minutes. Please specify Gateway Sensors for a better experience",
+                "No Gateway Sensors specified, Monitor-APP will run Arrive and Depart"
+                f" Scan every {self.scan_interval_min} to {self.scan_interval_max}"
+                " seconds, depending on activity in the home. Please specify Gateway"
+                " Sensors for a better experience",
                 level="WARNING",
             )
-            self.adapi.run_every(
-                self.run_arrive_scan, self.adapi.datetime() + timedelta(seconds=1), 60
-            )
-            self.adapi.run_every(
-                self.run_depart_scan, self.adapi.datetime() + timedelta(seconds=2), 60
-            )
+            self.scan_timer = self.adapi.run_in(self.run_adaptive_scan, 1)
+            self.adapi.run_daily(self.decay_presence_history, "00:00:00")
 
         # Setup home motion sensors, used for RSSI tracking
         for motion_sensor in self.args.get("home_motion_sensors", []):
             (namespace, sensor) = self.parse_sensor(motion_sensor)
             self.adapi.listen_state(self.motion_detected, sensor, namespace=namespace)
 
+        # the nodes nearest to each motion sensor, which scan when it detects motion
+        self.motion_nodes = {
+            self.parse_sensor(sensor)[1]: self.scan_locations(nodes)
+            for sensor, nodes in self.args.get("motion_sensor_nodes", {}).items()
+        }
+
         if self.args.get("scheduled_restart") is not None:
             kwargs = {}
             if "time" in self.args["scheduled_restart"]:
-                time = self.args["scheduled_restart"]["time"]
+                restart_time = self.args["scheduled_restart"]["time"]
 
                 if "days" in self.args["scheduled_restart"]:
                     kwargs["constrain_days"] = ",".join(
@@ -163,7 +1019,7 @@ class HomePresenceApp(ad.ADBase):
                     kwargs["location"] = self.args["scheduled_restart"]["location"]
 
                 self.adapi.log("Setting up Monitor auto reboot")
-                self.adapi.run_daily(self.restart_device, time, **kwargs)
+                self.adapi.run_daily(self.restart_device, restart_time, **kwargs)
 
             else:
                 self.adapi.log(
@@ -171,16 +1027,19 @@ class HomePresenceApp(ad.ADBase):
                     level="WARNING",
                 )
 
+        # Setup the connections used to run commands on the nodes
+        self.ssh_pool = SSHPool(
+            self.args.get("remote_monitors", {}),
+            float(self.args.get("ssh_connect_timeout", 10)),
+            self.args.get("ssh_keepalive", 30),
+            self.args.get("ssh_max_channels", 2),
+        )
+        self.adapi.run_every(self.evict_ssh_connections, "now+60", 60)
+
         # Setup the system checks.
         if self.system_timeout > system_check:
-            topic = f"{self.monitor_topic}/echo"
             self.adapi.run_every(
-                self.send_mqtt_message,
-                self.adapi.datetime() + timedelta(seconds=1),
-                system_check,
-                topic=topic,
-                payload="",
-                scan_type="System",
+                self.send_echo, self.adapi.datetime() + timedelta(seconds=1), system_check
             )
         else:
             self.adapi.log(
@@ -189,6 +1048,9 @@ class HomePresenceApp(ad.ADBase):
                 level="WARNING",
             )
 
+        # Setup the dispatch table used to route messages by action
+        self.setup_message_routes()
+
         # subscribe to the mqtt topic
         self.mqtt.mqtt_subscribe(f"{self.monitor_topic}/#")
 
@@ -203,15 +1065,290 @@ class HomePresenceApp(ad.ADBase):
         # Listen for any HASS restarts
         self.hass.listen_event(self.hass_restarted, "plugin_restarted")
 
+        # Restore the presence saved before the restart, so it is available
+        # while the nodes report again
+        self.snapshot_file = self.args.get("snapshot_file")
+        if self.snapshot_file is not None:
+            self.restore_presence_snapshot()
+
+            interval = self.args.get("snapshot_interval", 60)
+            self.adapi.run_every(
+                self.save_presence_snapshot, f"now+{interval}", interval
+            )
+
         # Load the devices from the config.
         self.adapi.run_in(self.clean_devices, 0)  # clean old devices first
         self.setup_service()  # setup service
 
+        # report how many HASS writes have been saved
+        self.adapi.run_every(
+            self.update_write_stats, f"now+{system_check}", system_check
+        )
+
+        if self.performance is not None:
+            interval = self.args.get("performance_interval", 60)
+            self.adapi.run_every(
+                self.publish_performance, f"now+{interval}", interval
+            )
+
+        if self.state_delta:
+            # publish full states now and then, for subscribers joining late
+            self.adapi.run_every(
+                self.publish_state_snapshots,
+                f"now+{forward_snapshot_interval}",
+                forward_snapshot_interval,
+            )
+
         # now this is to be ran, every hour to clean strayed location data
         self.adapi.run_every(
             self.run_location_clean, f"now+{self.system_timeout + 30}", 3600
         )
 
+    def load_registry(self):
+        """Rebuild the device registry from the state already in AppDaemon."""
+        conf_prefix = f"sensor.{self.monitor_name}_"
+        sensors = self.hass.get_state("sensor", copy=False, default={})
+        for entity_id, entity_state in sensors.items():
+            if not entity_id.startswith(conf_prefix):
+                continue
+
+            location = entity_state.get("attributes", {}).get("location")
+            conf_suffix = f"_{location}_conf"
+            if location is None or not entity_id.endswith(conf_suffix):
+                continue
+
+            device_name = entity_id[len(conf_prefix) : -len(conf_suffix)]
+            record = self.registry.add(device_name, location)
+            record.load(entity_state)
+            self.registry.set_identity(
+                record.device,
+                record.attributes.get("id"),
+                record.attributes.get("name"),
+            )
+
+        state_sensors = self.hass.get_state(
+            self.user_device_domain, copy=False, default={}
+        )
+        for entity_id, entity_state in state_sensors.items():
+            device = self.registry.entities.get(entity_id)
+            if isinstance(device, DeviceRecord):
+                device.load(entity_state)
+
+        for entity_id in self.mqtt.get_state(
+            self.user_device_domain, copy=False, default={}
+        ):
+            device = self.registry.entities.get(entity_id)
+            if isinstance(device, DeviceRecord):
+                device.mqtt_exists = True
+
+        entity_prefix = f"{self.monitor_name}."
+        entities = self.mqtt.get_state(self.monitor_name, copy=False, default={})
+        for entity_id, entity_state in entities.items():
+            location = entity_state.get("attributes", {}).get("location")
+            if location is None or not entity_id.endswith(f"_{location}"):
+                continue
+
+            device_name = entity_id[len(entity_prefix) : -len(location) - 1]
+            record = self.registry.add(device_name, location)
+            self.registry.set_identity(
+                record.device,
+                entity_state["attributes"].get("id"),
+                entity_state["attributes"].get("name"),
+            )
+
+        self.adapi.log(
+            f"Loaded {len(self.registry.devices)} devices into the registry",
+            level="DEBUG",
+        )
+
+    def save_presence_snapshot(self, kwargs):
+        """Save what is known of the presence of the devices and the nodes."""
+        devices = dict()
+        for device in self.registry.devices.values():
+            if not device.tracked:
+                continue
+
+            devices[device.device_name] = {
+                "mac": device.mac,
+                "name": device.name,
+                "presence": device.presence,
+                "nearest": device.nearest,
+                "confidence": device.confidence,
+                "rssi": device.rssi,
+                "not_home_timer": self.not_home_timers.get(device.device_entity_id)
+                is not None,
+            }
+
+        # serialise now, as the records change while the file is written
+        snapshot = json.dumps(
+            {
+                "version": __VERSION__,
+                "saved": self.adapi.get_now_ts(),
+                "devices": devices,
+                "nodes": self.node_states,
+            }
+        )
+
+        if kwargs.get("wait") is True:
+            self.write_presence_snapshot(snapshot)
+        else:
+            self.adapi.submit_to_executor(self.write_presence_snapshot, snapshot)
+
+    def write_presence_snapshot(self, snapshot):
+        """Write the snapshot to a temporary file, then move it in place."""
+        temp_file = f"{self.snapshot_file}.tmp"
+        try:
+            with open(temp_file, "w") as snapshot_file:
+                snapshot_file.write(snapshot)
+                snapshot_file.flush()
+                os.fsync(snapshot_file.fileno())
+
+            os.replace(temp_file, self.snapshot_file)
+
+        except OSError as error:
+            self.adapi.log(
+                f"Could not save the presence snapshot: {error}", level="WARNING"
+            )
+
+    def restore_presence_snapshot(self):
+        """Restore the presence of the devices and nodes from the snapshot.
+
+        What is restored is provisional. The confidence sensors are listened
+        to as when a node reports them, so the live reports take over, and
+        nodes which don't reply to the echoes are cleared as usual.
+        """
+        try:
+            with open(self.snapshot_file) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+
+        except FileNotFoundError:
+            return
+
+        except (OSError, ValueError) as error:
+            self.adapi.log(
+                f"Could not read the presence snapshot: {error}", level="WARNING"
+            )
+            return
+
+        age = self.adapi.get_now_ts() - snapshot.get("saved", 0)
+        if age > self.args.get("snapshot_max_age", 900):
+            self.adapi.log(
+                f"Not restoring the presence snapshot, as it is {round(age)}s old"
+            )
+            return
+
+        for location, state in snapshot.get("nodes", {}).items():
+            if state != "online":
+                continue
+
+            self.node_states[location] = state
+            self.locations.add(location)
+            self.handle_nodes_state(location, state)
+
+            # cleared, unless the node replies to an echo before
+            self.location_timers[location] = self.adapi.run_in(
+                self.clear_location_entities, self.system_timeout, location=location
+            )
+
+        restored = 0
+        for device_name, saved in snapshot.get("devices", {}).items():
+            mac = saved.get("mac")
+            if mac not in self.known_devices and mac not in self.known_beacons:
+                continue
+
+            if saved.get("presence") not in (self.state_true, self.state_false):
+                continue
+
+            self.restore_device(device_name, saved)
+            restored += 1
+
+        self.update_occupancy_sensors()
+        self.adapi.log(
+            f"Restored the presence of {restored} devices, saved {round(age)}s ago"
+        )
+
+    def restore_device(self, device_name, saved):
+        """Restore a device from the snapshot, and listen to its sensors."""
+        device = self.registry.add_device(device_name)
+        self.registry.set_identity(device, saved.get("mac"), saved.get("name"))
+        friendly_name = device_name.strip().replace("_", " ").title()
+
+        for location, confidence in saved.get("confidence", {}).items():
+            record = self.registry.add(device_name, location)
+            if not record.exists and not self.load_hass_record(record):
+                # HASS lost the sensor, so wait for the node to report it
+                continue
+
+            device.update_confidence(location, confidence, self.minimum_conf)
+            rssi = saved.get("rssi", {}).get(location)
+            if rssi is not None:
+                device.update_rssi(location, rssi, self.nearest_monitor_margin)
+
+            self.mqtt.set_state(
+                record.appdaemon_entity,
+                state=confidence,
+                attributes={
+                    "id": device.mac,
+                    "name": device.name,
+                    "location": location,
+                    "rssi": rssi if rssi is not None else "unknown",
+                },
+            )
+
+            if record.handle is None:
+                record.handle = self.hass.listen_state(
+                    self.confidence_updated, record.entity_id, device_name=device_name
+                )
+
+        presence = saved.get("presence")
+        nearest = saved.get("nearest")
+        if nearest in device.rssi:
+            device.nearest = nearest
+
+        nearest_monitor = (device.nearest or "unknown").replace("_", " ").title()
+        attributes = {
+            "friendly_name": f"{friendly_name} Home",
+            "device_class": "presence",
+            "nearest_monitor": nearest_monitor,
+        }
+        self.mqtt.set_state(device.entity_id, state=presence, attributes=attributes)
+        device.mqtt_exists = True
+
+        if device.exists or self.load_hass_record(device):
+            self.update_hass_sensor(
+                device.entity_id, presence, {"nearest_monitor": nearest_monitor}
+            )
+        else:
+            self.hass.set_state(device.entity_id, state=presence, attributes=attributes)
+            device.state = presence
+            device.attributes = attributes
+            device.exists = True
+
+        if device.handle is None:
+            device.handle = self.mqtt.listen_state(
+                self.device_state_changed, device.entity_id, device_name=device_name
+            )
+
+        self.registry.set_presence(device, presence)
+
+        timer = None
+        if saved.get("not_home_timer"):
+            # it was going away, so give it the full timeout again
+            timer = self.adapi.run_in(
+                self.not_home_func, self.timeout, device_name=device_name
+            )
+
+        elif presence == self.state_true and device.above == 0:
+            # no sensor restored keeps it home, so it only is till the nodes
+            # had the time to report it again
+            timer = self.adapi.run_in(
+                self.not_home_func,
+                self.system_timeout + self.timeout,
+                device_name=device_name,
+            )
+
+        self.not_home_timers[device.device_entity_id] = timer
+
     def setup_global_sensors(self):
         """Add all global home/not_home sensors."""
         everyone_not_home = self.args.get("everyone_not_home", "everyone_not_home")
@@ -242,141 +1379,258 @@ class HomePresenceApp(ad.ADBase):
             f"binary_sensor.{sensor}", state="off", attributes=attributes
         )
 
+    def setup_message_routes(self):
+        """Setup the dispatch table for messages received on the MQTT Topic."""
+        self.message_routes = dict()
+        self.topic_cache = dict()
+
+        # messages not sent for a known action are device confidence reports
+        self.default_route = MessageRoute(
+            None, "{location}/{device}", self.handle_device_message, decode_json=True
+        )
+
+        for action in IGNORED_ACTIONS:
+            self.register_message_route(action, None)
+
+        for action in SETUP_ACTIONS:
+            self.register_message_route(action, self.handle_setup_ack)
+
+        self.register_message_route("run_scan", self.handle_run_scan, "run_scan")
+        self.register_message_route("restart", self.handle_restart)
+        self.register_message_route("status", self.handle_status)
+        self.register_message_route(
+            "start", self.handle_scanning, "{location}/{scan_type}/start"
+        )
+        self.register_message_route(
+            "end", self.handle_scanning, "{location}/{scan_type}/end"
+        )
+        self.register_message_route("echo", self.handle_echo)
+        self.register_message_route("reboot", self.handle_reboot)
+        self.register_message_route(
+            "rssi", self.handle_rssi, "{location}/{device}/rssi"
+        )
+
+    def register_message_route(
+        self, action, handler, template=None, decode_json=False
+    ):
+        """Register the handler for an action received on the MQTT Topic.
+
+        The handler is called with the topic, payload, decoded JSON payload
+        and the fields named in the template as keyword arguments. A handler
+        of None discards messages for that action.
+        """
+        action = action.lower()
+        if template is None:
+            template = f"{{location}}/{action}"
+
+        self.message_routes[action] = MessageRoute(
+            action, template, handler, decode_json=decode_json
+        )
+
+        # previously parsed topics might now be routed differently
+        self.topic_cache.clear()
+
+    def parse_topic(self, topic):
+        """Route a topic to its handler and extract its fields."""
+        topic_path = topic.split("/")[self.topic_level :]
+        action = topic_path[-1].lower() if topic_path else ""
+        route = self.message_routes.get(action, self.default_route)
+        fields = route.match(topic_path)
+        fields["action"] = action
+
+        if fields.get("location") is not None:
+            fields["location"] = fields["location"].replace(" ", "_").lower()
+
+        device_name = fields.get("device")
+        if device_name is not None:
+            # Handle Beacon Topics in MAC or iBeacon ID formats and make friendly.
+            if device_name in self.known_beacons:
+                device_name = self.known_beacons[device_name]
+            else:
+                device_name = device_name.replace(":", "_").replace("-", "_")
+
+            fields["device"] = device_name
+
+        if len(self.topic_cache) >= TOPIC_CACHE_SIZE:
+            self.topic_cache.clear()
+
+        self.topic_cache[topic] = (route, fields)
+        return route, fields
+
     def presence_message(self, event_name, data, kwargs):
         """Process a message sent on the MQTT Topic."""
         topic = data.get("topic")
         payload = data.get("payload")
         self.adapi.log(f"{topic} payload: {payload}", level="DEBUG")
 
-        topic_path = topic.split("/")
-        action = topic_path[-1].lower()
+        if self.capture is not None:
+            self.capture.info(json.dumps([round(time.monotonic(), 3), topic, payload]))
 
-        # Process the payload as JSON if it is JSON
-        payload_json = {}
-        try:
-            payload_json = json.loads(payload)
-        except ValueError:
-            pass
-
-        # Handle request for immediate scan via MQTT
-        # can be arrive/depart/rssi
-        if action == "run_scan":
-            # add scan_delay=0 to ensure its done immediately
-            self.mqtt.call_service(
-                f"{self.monitor_topic}/run_{payload.lower()}_scan", scan_delay=0
-            )
+        parsed = self.topic_cache.get(topic)
+        if parsed is None:
+            parsed = self.parse_topic(topic)
+
+        route, fields = parsed
+
+        # Miscellaneous Actions, Discard
+        if route.handler is None:
             return
 
-        # Determine which scanner initiated the message
-        location = None
-        if isinstance(payload_json, dict) and "identity" in payload_json:
-            location = payload_json.get("identity")
+        # Only process the payload as JSON for actions that use it
+        payload_json = {}
+        location = fields.get("location")
+        if route.decode_json:
+            payload_json = self.decode_payload(payload)
 
-        elif len(topic_path) > self.topic_level + 1:
-            location = topic_path[self.topic_level]
+            # Determine which scanner initiated the message
+            if isinstance(payload_json, dict) and "identity" in payload_json:
+                location = payload_json.get("identity")
+                if location is not None:
+                    location = location.replace(" ", "_").lower()
 
-        if location in (None, "None", ""):
+        if "location" in fields and location in (None, "None", "none", ""):
             # got an invalid location
 
-            if action in IGNORED_ACTIONS + [
-                "echo"
-            ]:  # its echo, so recieved possibly from himself
-                pass
-
-            else:
+            # its echo or setup, so recieved possibly from himself
+            if route.action != "echo" and route.action not in SETUP_ACTIONS:
                 self.adapi.log(
                     f"Got an invalid location {location}, from topic {topic}",
                     level="WARNING",
                 )
             return
 
-        location = location.replace(" ", "_").lower()
-        location_friendly = location.replace("_", " ").title()
+        route.handler(
+            **dict(
+                fields,
+                topic=topic,
+                payload=payload,
+                payload_json=payload_json,
+                location=location,
+            )
+        )
 
-        # Presence System is Restarting
-        if action == "restart":
-            self.adapi.log("The Entire Presence System is Restarting")
-            return
+    def setup_capture(self, capture_file):
+        """Capture the messages received to a rotating file.
 
-        # Miscellaneous Actions, Discard
-        if action in IGNORED_ACTIONS:
-            return
+        Each line is the JSON list of the monotonic time, topic and payload
+        of a message, which tools/replay_capture.py can replay.
+        """
+        handler = logging.handlers.RotatingFileHandler(
+            capture_file,
+            maxBytes=int(self.args.get("capture_max_size", 10485760)),
+            backupCount=int(self.args.get("capture_backups", 3)),
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
 
-        # Status Message from the Presence System
-        if action == "status":
-            self.handle_status(location=location, payload=payload.lower())
-            return
+        self.capture = logging.getLogger(f"{__name__}.capture.{self.monitor_name}")
+        self.capture.propagate = False
+        self.capture.setLevel(logging.INFO)
+        self.close_capture()
+        self.capture.addHandler(handler)
 
-        if action in ["start", "end"]:
-            self.handle_scanning(
-                action=action,
-                location=location,
-                scan_type=topic_path[self.topic_level + 1],
-            )
-            return
+        self.adapi.log(f"Capturing the messages received to {capture_file}")
+
+    def close_capture(self):
+        """Close the capture files, including those of a previous run."""
+        for handler in list(self.capture.handlers):
+            self.capture.removeHandler(handler)
+            handler.close()
+
+    def decode_payload(self, payload):
+        """Process the payload as JSON if it is a JSON object.
+
+        Payloads which can't be one, like rssi values, echoes and status, are
+        not parsed at all.
+        """
+        if not isinstance(payload, str):
+            return {}
+
+        if payload[:1] != "{" and payload.lstrip()[:1] != "{":
+            return {}
+
+        try:
+            return json_loads(payload)
+        except ValueError:
+            return {}
+
+    def handle_run_scan(self, payload, **kwargs):
+        """Handle request for immediate scan via MQTT.
+
+        Can be arrive/depart/rssi.
+        """
+        # add scan_delay=0 to ensure its done immediately
+        self.mqtt.call_service(
+            f"{self.monitor_topic}/run_{payload.lower()}_scan", scan_delay=0
+        )
 
-        # Response to Echo Check of Scanner
-        if action == "echo":
-            self.handle_echo(location=location, payload=payload)
+    def handle_restart(self, **kwargs):
+        """Presence System is Restarting."""
+        self.adapi.log("The Entire Presence System is Restarting")
+
+    def handle_setup_ack(self, topic, action, location, **kwargs):
+        """Handle a node acknowledging a setup instruction."""
+        if location in ("setup", "scan") or "/setup/" in topic:
+            # its the instruction sent by the app
             return
 
-        # Handle request for reboot of hardware
-        if action == "reboot":
-            self.adapi.run_in(self.restart_device, 1, location=location)
+        if action == "add static device":
+            self.device_loaded(location)
+
+        self.provision_ack(location, action)
+
+    def handle_reboot(self, location, **kwargs):
+        """Handle request for reboot of hardware."""
+        self.adapi.run_in(self.restart_device, 1, location=location)
+
+    def handle_rssi(self, topic, payload, location, device, **kwargs):
+        """Handle an RSSI Value for a Known Device."""
+        if topic == f"{self.monitor_topic}/scan/rssi" or payload == "":
             return
 
-        device_name = topic_path[self.topic_level + 1]
-        # Handle Beacon Topics in MAC or iBeacon ID formats and make friendly.
-        if device_name in list(self.known_beacons.keys()):
-            device_name = self.known_beacons[device_name]
-        else:
-            device_name = device_name.replace(":", "_").replace("-", "_")
-
-        device_entity_id = f"{self.monitor_name}_{device_name}"
-        device_state_sensor = f"{self.user_device_domain}.{device_entity_id}"
-        device_entity_prefix = f"{device_entity_id}_{location}"
-        device_conf_sensor = f"sensor.{device_entity_prefix}_conf"
-        device_local = f"{device_name}_{location}"
-        appdaemon_entity = f"{self.monitor_name}.{device_local}"
-        friendly_name = device_name.strip().replace("_", " ").title()
+        device_name = device
+        location_friendly = location.replace("_", " ").title()
 
         # store the location
         self.locations.add(location)
 
-        # RSSI Value for a Known Device:
-        if action == "rssi":
-            if topic == f"{self.monitor_topic}/scan/rssi" or payload == "":
-                return
+        attributes = {
+            "rssi": payload,
+            "last_reported_by": location_friendly,
+        }
+        self.adapi.log(
+            f"Recieved an RSSI of {payload} for {device_name} from {location_friendly}",
+            level="DEBUG",
+        )
 
-            attributes = {
-                "rssi": payload,
-                "last_reported_by": location.replace("_", " ").title(),
-            }
-            self.adapi.log(
-                f"Recieved an RSSI of {payload} for {device_name} from {location_friendly}",
-                level="DEBUG",
-            )
+        record = self.registry.get(device_name, location)
+        if (
+            record is not None
+            and record.exists
+            and record.device.presence == self.state_true
+        ):
+            # unless it exists, and the device is home don't update RSSI
+            self.mqtt.set_state(record.appdaemon_entity, attributes=attributes)
+            self.update_hass_sensor(record.entity_id, new_attr={"rssi": payload})
+            self.update_nearest_monitor(record, payload)
+
+    def handle_device_message(self, payload_json, location, device, **kwargs):
+        """Handle a confidence report for a device from a location."""
+        device_name = device
+        location_friendly = location.replace("_", " ").title()
+        friendly_name = device_name.strip().replace("_", " ").title()
 
-            if (
-                self.hass.entity_exists(device_conf_sensor)
-                and self.hass.get_state(device_state_sensor, copy=False)
-                == self.state_true
-            ):
-                # unless it exists, and the device is home don't update RSSI
-                self.mqtt.set_state(appdaemon_entity, attributes=attributes)
-                self.update_hass_sensor(device_conf_sensor, new_attr={"rssi": payload})
-                self.update_nearest_monitor(device_name)
-            return
+        # store the location
+        self.locations.add(location)
 
         # Ignore invalid JSON responses
-        if not payload_json:
+        if not payload_json or not isinstance(payload_json, dict):
             return
 
         # Ignore unknown/bad types and unknown beacons
         if payload_json.get("type") not in [
             "KNOWN_MAC",
             "GENERIC_BEACON",
-        ] and payload_json.get("id") not in list(self.known_beacons.keys()):
+        ] and payload_json.get("id") not in self.known_beacons:
             self.adapi.log(
                 f"Ignoring Beacon {payload_json.get('id')} because it is not in the known_beacons list.",
                 level="DEBUG",
@@ -394,91 +1648,104 @@ class HomePresenceApp(ad.ADBase):
 
         state = self.state_true if confidence >= self.minimum_conf else self.state_false
 
-        if not self.hass.entity_exists(device_conf_sensor):
+        record = self.registry.add(device_name, location)
+        device = record.device
+        self.registry.set_identity(
+            device, payload_json.get("id"), payload_json.get("name")
+        )
+        self.node_devices.setdefault(location, set()).add(payload_json.get("id"))
+
+        if not record.exists and not self.load_hass_record(record):
             # Entity does not exist in HASS yet.
             self.adapi.log(
-                "Creating sensor {!r} for Confidence".format(device_conf_sensor)
-            )
-            self.hass.set_state(
-                device_conf_sensor,
-                state=confidence,
-                attributes={
-                    "friendly_name": f"{friendly_name} {location_friendly} Confidence",
-                    "unit_of_measurement": "%",
-                },
+                "Creating sensor {!r} for Confidence".format(record.entity_id)
             )
+            attributes = {
+                "friendly_name": f"{friendly_name} {location_friendly} Confidence",
+                "unit_of_measurement": "%",
+            }
+            self.hass.set_state(record.entity_id, state=confidence, attributes=attributes)
+            record.state = confidence
+            record.attributes = attributes
+            record.exists = True
 
-        if not self.hass.entity_exists(device_state_sensor):
+        if not device.exists and not self.load_hass_record(device):
             # Device Home Presence Sensor Doesn't Exist Yet in Hass so create it
             self.adapi.log(
-                "Creating sensor {!r} for Home State".format(device_state_sensor),
-                level="DEBUG",
-            )
-            self.hass.set_state(
-                device_state_sensor,
-                state=state,
-                attributes={
-                    "friendly_name": f"{friendly_name} Home",
-                    "type": payload_json.get("type", "UNKNOWN_TYPE"),
-                    "device_class": "presence",
-                },
-            )
-
-        if not self.mqtt.entity_exists(device_state_sensor):
-            # Device Home Presence Sensor Doesn't Exist Yet in default so create it
-            self.adapi.log(
-                "Creating sensor {!r} for Home State".format(device_state_sensor),
+                "Creating sensor {!r} for Home State".format(device.entity_id),
                 level="DEBUG",
             )
-            self.mqtt.set_state(
-                device_state_sensor,
-                state=state,
-                attributes={
-                    "friendly_name": f"{friendly_name} Home",
-                    "type": payload_json.get("type", "UNKNOWN_TYPE"),
-                    "device_class": "presence",
-                },
-            )
+            attributes = {
+                "friendly_name": f"{friendly_name} Home",
+                "type": payload_json.get("type", "UNKNOWN_TYPE"),
+                "device_class": "presence",
+            }
+            self.hass.set_state(device.entity_id, state=state, attributes=attributes)
+            device.state = state
+            device.attributes = attributes
+            device.exists = True
+
+        if not device.mqtt_exists:
+            if not self.mqtt.entity_exists(device.entity_id):
+                # Device Home Presence Sensor Doesn't Exist Yet in default so create it
+                self.adapi.log(
+                    "Creating sensor {!r} for Home State".format(device.entity_id),
+                    level="DEBUG",
+                )
+                self.mqtt.set_state(
+                    device.entity_id,
+                    state=state,
+                    attributes={
+                        "friendly_name": f"{friendly_name} Home",
+                        "type": payload_json.get("type", "UNKNOWN_TYPE"),
+                        "device_class": "presence",
+                    },
+                )
 
-        if device_entity_id not in self.home_state_entities:
-            self.home_state_entities[device_entity_id] = list()
+            device.mqtt_exists = True
 
         # Add listeners to the conf sensors to update the main state sensor on change.
-        if device_conf_sensor not in self.home_state_entities[device_entity_id]:
-            self.home_state_entities[device_entity_id].append(device_conf_sensor)
-            self.confidence_handlers[device_conf_sensor] = self.hass.listen_state(
+        if record.handle is None:
+            record.handle = self.hass.listen_state(
                 self.confidence_updated,
-                device_conf_sensor,
-                device_entity_id=device_entity_id,
+                record.entity_id,
+                device_name=device_name,
                 immediate=True,
             )
 
         # Actually update the confidence sensor.
+        device.update_confidence(location, confidence, self.minimum_conf)
         payload_json["location"] = location
-        self.update_hass_sensor(device_conf_sensor, confidence, new_attr=payload_json)
-        self.mqtt.set_state(appdaemon_entity, state=confidence, attributes=payload_json)
+        self.update_hass_sensor(record.entity_id, confidence, new_attr=payload_json)
+        self.mqtt.set_state(
+            record.appdaemon_entity, state=confidence, attributes=payload_json
+        )
 
         # Set the nearest monitor property if we have a new RSSI.
         if "rssi" in payload_json:
-            self.update_nearest_monitor(device_name)
-
-        if device_state_sensor not in self.all_users_sensors:
-            self.all_users_sensors.append(device_state_sensor)
+            self.update_nearest_monitor(record, payload_json["rssi"])
 
+        if device.handle is None:
             # now listen to this sensor's state changes
             # used to check if the user was not home before, and if home run rssi immediately to determine closest monitor
-            self.mqtt.listen_state(
+            device.handle = self.mqtt.listen_state(
                 self.device_state_changed,
-                device_state_sensor,
+                device.entity_id,
                 device_name=device_name,
                 immediate=True,
             )
 
-        if device_entity_id not in self.not_home_timers:
-            self.not_home_timers[device_entity_id] = None
+            # count the user in the home's occupancy
+            if not device.tracked:
+                self.registry.set_presence(device, device.state)
+                self.update_occupancy_sensors()
 
-    def handle_status(self, location, payload):
+        if device.device_entity_id not in self.not_home_timers:
+            self.not_home_timers[device.device_entity_id] = None
+
+    def handle_status(self, location, payload, **kwargs):
         """Handle a status message from the presence system."""
+        payload = payload.lower()
         location_friendly = location.replace("_", " ").title()
         self.adapi.log(
             f"The {location_friendly} Presence System is {payload.title()}.",
@@ -521,8 +1788,8 @@ class HomePresenceApp(ad.ADBase):
                     "location": location_friendly,
                 }
             )
-            # Load devices for all locations:
-            self.adapi.run_in(self.load_known_devices, 30)
+            # Load devices for the new location:
+            self.adapi.run_in(self.load_known_devices, 30, location=location)
 
         self.mqtt.set_state(entity_id, state=payload, attributes=attributes)
 
@@ -536,7 +1803,7 @@ class HomePresenceApp(ad.ADBase):
                 self.forward_monitor_state, entity_id, attribute="all", immediate=True,
             )
 
-    def handle_scanning(self, action, location, scan_type):
+    def handle_scanning(self, action, location, scan_type, **kwargs):
         """Handle a Monitor location starting or stopping a scan."""
         old_state = self.mqtt.get_state(self.monitor_entity, copy=False)
         locations_attr = self.mqtt.get_state(self.monitor_entity, attribute="locations")
@@ -556,23 +1823,60 @@ class HomePresenceApp(ad.ADBase):
                 attributes["locations"] = [location]
             elif location not in locations_attr:
                 attributes["locations"].append(location)
+
+            # the scan sent to it, or to all nodes, has started
+            self.scanning_since[location] = time.monotonic()
+            self.scan_sent.pop(location, None)
+            self.scan_sent.pop(None, None)
+
         # Scan has just finished.
-        elif action == "end" and location in locations_attr:
-            attributes["locations"].remove(location)
+        elif action == "end":
+            self.scanning_since.pop(location, None)
+            if location in locations_attr:
+                attributes["locations"].remove(location)
+
+        # the system is scanning as long as any node is
+        state = "scanning" if attributes.get("locations") else "idle"
+
+        self.mqtt.set_state(self.monitor_entity, state=state, attributes=attributes)
+
+        if action == "end":
+            # the node is free, so send the next scan waiting
+            self.dispatch_scan()
 
-        last_one = old_state != new_state and not attributes.get("locations")
+    def send_echo(self, kwargs):
+        """Send an echo to the nodes, to check they are still online."""
+        self.echo_seq += 1
+        self.echo_sent[self.echo_seq] = time.monotonic()
+        self.echo_sent.pop(self.echo_seq - 4, None)  # too old to be replied to
 
-        self.mqtt.set_state(
-            self.monitor_entity,
-            state="scanning" if not last_one else "idle",
-            attributes=attributes,
+        payload = json.dumps(
+            {"seq": self.echo_seq, "timestamp": self.adapi.datetime().isoformat()}
         )
+        self.mqtt.mqtt_publish(f"{self.monitor_topic}/echo", payload)
 
-    def handle_echo(self, location, payload):
+    def handle_echo(self, location, payload, **kwargs):
         """Handle an echo response from a scanner."""
         self.adapi.log(f"Echo received from {location}: {payload}", level="DEBUG")
-        if payload != "ok":
-            return
+        answered = self.echo_answered.get(location, 0)
+        if payload == "ok":
+            # the reply is for the oldest echo the node hasn't replied to, but
+            # if a newer one was sent since, it can't be told which it was
+            unanswered = [seq for seq in self.echo_sent if seq > answered]
+            seq = self.echo_seq if unanswered == [self.echo_seq] else None
+            self.echo_answered[location] = self.echo_seq
+
+        else:
+            reply = self.decode_payload(payload)
+            if not isinstance(reply, dict) or "seq" not in reply:
+                return
+
+            seq = reply["seq"]
+            if isinstance(seq, int) and seq > answered:
+                self.echo_answered[location] = seq
+
+        if seq in self.echo_sent and seq > answered:
+            self.record_echo_rtt(location, time.monotonic() - self.echo_sent[seq])
 
         entity_id = f"{self.monitor_name}.{location}_state"
         if location in self.location_timers and self.adapi.timer_running(
@@ -581,7 +1885,9 @@ class HomePresenceApp(ad.ADBase):
             self.adapi.cancel_timer(self.location_timers[location])
 
         self.location_timers[location] = self.adapi.run_in(
-            self.clear_location_entities, self.system_timeout, location=location
+            self.clear_location_entities,
+            self.offline_timeout(location),
+            location=location,
         )
 
         if self.mqtt.get_state(entity_id, copy=False) != "online":
@@ -589,6 +1895,58 @@ class HomePresenceApp(ad.ADBase):
 
             self.handle_nodes_state(location, "online")
 
+    def record_echo_rtt(self, location, rtt):
+        """Record the round trip time of a node's echo, and report its latency."""
+        rtts = self.echo_rtts.get(location)
+        if rtts is None:
+            rtts = self.echo_rtts[location] = deque(
+                maxlen=self.args.get("echo_history", 100)
+            )
+
+        rtts.append(rtt * 1000)
+
+        reported = (
+            round(self.echo_percentile(location, 0.5)),
+            round(self.echo_percentile(location, 0.95)),
+            round(self.offline_timeout(location)),
+        )
+        if self.echo_reported.get(location) == reported:
+            return
+
+        self.echo_reported[location] = reported
+        self.mqtt.set_state(
+            f"{self.monitor_name}.{location}_state",
+            echo_rtt=reported[0],
+            echo_rtt_p95=reported[1],
+            offline_timeout=reported[2],
+        )
+
+    def echo_percentile(self, location, percentile):
+        """Get a percentile of a node's echo round trip times in ms."""
+        rtts = sorted(self.echo_rtts.get(location, ()))
+        if not rtts:
+            return 0
+
+        return rtts[round(percentile * (len(rtts) - 1))]
+
+    def offline_timeout(self, location):
+        """Get the time a node can go without replying to echoes, before its offline.
+
+        Once enough echoes were replied, this is the time till the echo after
+        next plus a margin on the node's 95th percentile latency, so a single
+        echo lost is not enough to declare it offline, while nodes with a fast
+        network are declared offline sooner. system_timeout is the most.
+        """
+        if len(self.echo_rtts.get(location, ())) < 5:
+            return self.system_timeout
+
+        margin = self.args.get("echo_timeout_factor", 3) * self.echo_percentile(
+            location, 0.95
+        )
+        return min(
+            self.system_timeout, 2 * self.system_check + max(margin / 1000, 5)
+        )
+
     def handle_nodes_state(self, location, state):
         """Used to handle the state of the nodes for reporting """
         location_friendly = location.replace("_", " ").title()
@@ -622,76 +1980,78 @@ class HomePresenceApp(ad.ADBase):
 
         self.mqtt.set_state(self.monitor_entity, attributes=attributes)
 
-    def update_nearest_monitor(self, device_name):
-        """Determine which monitor the device is closest to based on RSSI value."""
-        device_entity_id = f"{self.monitor_name}_{device_name}"
-        device_conf_sensors = self.home_state_entities.get(device_entity_id)
-        device_state_sensor = f"{self.user_device_domain}.{device_entity_id}"
+        self.node_states[location] = state
+        if state == "online":
+            self.provision_ack(location, "status")
+            self.resume_node_commands(location)
+
+        elif state == "offline":
+            # the node will have to report its devices again
+            self.node_devices.pop(location, None)
+
+    def online_nodes(self):
+        """Get the locations of the nodes that are online."""
+        return [node for node, state in self.node_states.items() if state == "online"]
+
+    def update_nearest_monitor(self, record, rssi):
+        """Determine which monitor the device is closest to based on RSSI value.
 
-        if device_conf_sensors is None:
+        The RSSI reported by the record's location is updated in the device's
+        RSSI table, and the nearest monitor only written if it changed.
+        """
+        device = record.device
+        if record.handle is None:
             self.adapi.log(
-                f"Got Confidence Value for {device_entity_id} but device"
+                f"Got Confidence Value for {device.device_entity_id} but device"
                 " is not set up (no sensors found).",
                 level="WARNING",
             )
             self.adapi.run_in(self.run_arrive_scan, 0)
             return
 
-        rssi_values = {
-            loc.replace(f"sensor.{device_entity_id}_", "").replace(
-                "_conf", ""
-            ): self.hass.get_state(loc, attribute="rssi")
-            for loc in device_conf_sensors
-        }
-
-        rssi_values = {
-            loc: int(rssi)
-            for loc, rssi in rssi_values.items()
-            if rssi is not None and rssi != "unknown"
-        }
+        device.update_rssi(record.location, rssi, self.nearest_monitor_margin)
 
         nearest_monitor = "unknown"
-        if rssi_values:
-            nearest_monitor = max(rssi_values, key=rssi_values.get)
-            self.adapi.log(
-                f"{device_entity_id} is closest to {nearest_monitor} based on last reported RSSI values",
-                level="DEBUG",
-            )
+        if device.nearest is not None:
+            nearest_monitor = device.nearest.replace("_", " ").title()
+
+        if nearest_monitor == device.attributes.get("nearest_monitor"):
+            return
 
-        nearest_monitor = nearest_monitor.replace("_", " ").title()
-        self.mqtt.set_state(device_state_sensor, nearest_monitor=nearest_monitor)
+        self.adapi.log(
+            f"{device.device_entity_id} is closest to {nearest_monitor} based on last reported RSSI values",
+            level="DEBUG",
+        )
+        self.mqtt.set_state(device.entity_id, nearest_monitor=nearest_monitor)
         self.update_hass_sensor(
-            device_state_sensor, new_attr={"nearest_monitor": nearest_monitor},
+            device.entity_id, new_attr={"nearest_monitor": nearest_monitor},
         )
 
     def confidence_updated(self, entity, attribute, old, new, kwargs):
         """Respond to a monitor providing a new confidence value."""
-        device_entity_id = kwargs["device_entity_id"]
-        device_state_sensor = f"{self.user_device_domain}.{device_entity_id}"
-        device_state_sensor_value = self.hass.get_state(device_state_sensor, copy=False)
-        device_type = self.hass.get_state(entity, attribute="type", copy=False)
-        device_conf_sensors = self.home_state_entities.get(device_entity_id)
+        device = self.registry.get_device(kwargs["device_name"])
+        record = self.registry.entities.get(entity)
 
-        if device_conf_sensors is None:
+        if device is None or record is None:
             self.adapi.log(
-                f"Got Confidence Value for {device_entity_id} but device"
-                " is not set up (no sensors found).",
+                f"Got Confidence Value for {self.monitor_name}_{kwargs['device_name']}"
+                " but device is not set up (no sensors found).",
                 level="WARNING",
             )
 
             self.adapi.run_in(self.run_arrive_scan, 0)
             return
 
+        device_entity_id = device.device_entity_id
+        device_state_sensor = device.entity_id
+        device_state_sensor_value = device.presence
+        device_type = record.attributes.get("type")
+
         if int(new) == 0:  # the confidence is 0, so rssi should be lower
             # unknown used just to ensure it doesn't clash with an active node
-            appdaemon_conf_sensor = self.hass_conf_sensor_to_appdaemon_conf(entity)
-            self.mqtt.set_state(appdaemon_conf_sensor, rssi="unknown")
+            self.mqtt.set_state(record.appdaemon_entity, rssi="unknown")
             self.update_hass_sensor(entity, new_attr={"rssi": "unknown"})
-
-        sensor_res = list(
-            map(lambda x: self.hass.get_state(x, copy=False), device_conf_sensors)
-        )
-        sensor_res = [i for i in sensor_res if i is not None and i != "unknown"]
+            self.update_nearest_monitor(record, "unknown")
 
         self.adapi.log(
             "Device State: {}, User Device Sensor: {}, Device Type {}, New: {}, State: {}".format(
@@ -704,9 +2064,7 @@ class HomePresenceApp(ad.ADBase):
             level="DEBUG",
         )
 
-        if sensor_res != [] and any(
-            list(map(lambda x: int(x) >= self.minimum_conf, sensor_res))
-        ):
+        if device.above > 0:
             # Cancel the running timer.
             if self.not_home_timers.get(
                 device_entity_id
@@ -720,22 +2078,10 @@ class HomePresenceApp(ad.ADBase):
             self.mqtt.set_state(device_state_sensor, state=self.state_true)
             self.update_hass_sensor(device_state_sensor, self.state_true)
 
-            # now check how many ppl are home
-            count = self.count_persons_in_home()
-            self.update_hass_sensor(
-                self.somebody_is_home, "on", new_attr={"count": count}
-            )
-
-            if device_state_sensor in self.all_users_sensors:
-                self.update_hass_sensor(self.everyone_not_home, "off")
-                if self.check_home_timer is not None and self.adapi.timer_running(
-                    self.check_home_timer
-                ):
-                    self.adapi.cancel_timer(self.check_home_timer)
-
-                self.check_home_timer = self.adapi.run_in(
-                    self.check_home_state, 2, check_state="is_home"
-                )
+            # now update how many ppl are home
+            if self.registry.set_presence(device, self.state_true):
+                self.record_presence_change()
+                self.update_occupancy_sensors()
             return
 
         if (
@@ -749,49 +2095,43 @@ class HomePresenceApp(ad.ADBase):
             self.adapi.run_in(self.run_arrive_scan, 0)
 
             self.not_home_timers[device_entity_id] = self.adapi.run_in(
-                self.not_home_func, self.timeout, device_entity_id=device_entity_id
+                self.not_home_func, self.timeout, device_name=device.device_name
             )
             self.adapi.log(f"Timer Started for {device_entity_id}", level="DEBUG")
 
     def device_state_changed(self, entity, attribute, old, new, kwargs):
         """Used to run RSSI scan in the event the device Left the house and re-entered"""
 
-        device_name = kwargs["device_name"]
-        device_entity_id = f"{self.monitor_name}_{device_name}"
+        device = self.registry.get_device(kwargs["device_name"])
         if new == self.state_true:  # device now home
             self.adapi.run_in(self.run_rssi_scan, 0)
 
-        elif new == self.state_false:  # device is away
-            device_conf_sensors = self.home_state_entities[device_entity_id]
+        elif new == self.state_false and device is not None:  # device is away
             # now set all of their sensor's rssi to unknown to indicate its way
-            for sensor in device_conf_sensors:
-                location = self.hass.get_state(sensor, attribute="location", copy=False)
-                device_local = f"{device_name}_{location}"
-                appdaemon_entity = f"{self.monitor_name}.{device_local}"
-                self.mqtt.set_state(appdaemon_entity, rssi="unknown")
-                self.update_hass_sensor(sensor, new_attr={"rssi": "unknown"})
+            for record in device.active_records():
+                self.mqtt.set_state(record.appdaemon_entity, rssi="unknown")
+                self.update_hass_sensor(record.entity_id, new_attr={"rssi": "unknown"})
+                self.update_nearest_monitor(record, "unknown")
 
     def not_home_func(self, kwargs):
         """Manage devices that are not home."""
-        device_entity_id = kwargs["device_entity_id"]
+        device = self.registry.get_device(kwargs["device_name"])
+        if device is None:
+            return
+
+        device_entity_id = device.device_entity_id
 
         # remove from dictionary
         self.not_home_timers.pop(device_entity_id, None)
 
-        device_state_sensor = f"{self.user_device_domain}.{device_entity_id}"
-        device_conf_sensors = self.home_state_entities[device_entity_id]
-        sensor_res = list(
-            map(lambda x: self.hass.get_state(x, copy=False), device_conf_sensors)
-        )
-
-        # Remove unknown values from list
-        sensor_res = [i for i in sensor_res if i is not None and i != "unknown"]
+        device_state_sensor = device.entity_id
 
         self.adapi.log(
-            f"Device Not Home: {device_entity_id}, Sensors: {sensor_res}", level="DEBUG"
+            f"Device Not Home: {device_entity_id}, Sensors: {device.confidence}",
+            level="DEBUG",
         )
 
-        if all(list(map(lambda x: int(x) < self.minimum_conf, sensor_res))):
+        if device.above == 0:
             # Confirm for the last time
             self.mqtt.set_state(
                 device_state_sensor, state=self.state_false, nearest_monitor="unknown"
@@ -800,18 +2140,10 @@ class HomePresenceApp(ad.ADBase):
                 device_state_sensor, self.state_false, {"nearest_monitor": "unknown"}
             )
 
-            if device_state_sensor in self.all_users_sensors:
-                # At least someone not home, set Everyone Home to off
-                self.update_hass_sensor(self.everyone_home, "off")
-
-                if self.check_home_timer is not None and self.adapi.timer_running(
-                    self.check_home_timer
-                ):
-                    self.adapi.cancel_timer(self.check_home_timer)
-
-                self.check_home_timer = self.adapi.run_in(
-                    self.check_home_state, 2, check_state="not_home"
-                )
+            # now update how many ppl are home
+            if self.registry.set_presence(device, self.state_false):
+                self.record_presence_change()
+                self.update_occupancy_sensors()
 
         self.not_home_timers[device_entity_id] = None
 
@@ -819,27 +2151,6 @@ class HomePresenceApp(ad.ADBase):
         """Send a MQTT Message."""
         topic = kwargs.get("topic")
         payload = kwargs.get("payload")
-        if kwargs["scan_type"] == "Depart":
-            count = kwargs.get("count", 0)
-            # Last Gateway Based Timer
-            self.gateway_timer = None
-
-            if self.mqtt.get_state(self.monitor_entity) == "idle":
-                self.mqtt.mqtt_publish(topic, payload)
-                # Scan for departure times. 3 as default
-                if count <= self.args.get("depart_scans", 3):
-                    count = count + 1
-                    self.adapi.run_in(self.run_depart_scan, 0, count=count)
-                return
-            # Scanner busy, re-run timer for it to get idle before
-            # sending the message to start scan
-            self.adapi.run_in(self.run_depart_scan, 0, scan_delay=10, count=count)
-            return
-
-        # Perform Arrival Scan
-        if kwargs["scan_type"] == "Arrive":
-            self.mqtt.mqtt_publish(topic, payload)
-            return
 
         # System Command, Send the raw payload
         if kwargs["scan_type"] == "System":
@@ -847,33 +2158,202 @@ class HomePresenceApp(ad.ADBase):
             return
 
     def update_hass_sensor(self, sensor, new_state=None, new_attr=None):
-        """Update the hass sensor if it has changed."""
-        if not self.hass.entity_exists(sensor):
+        """Update the hass sensor if it has changed.
+
+        The write is held back for the write window, so updates of the same
+        sensor within it are merged and written to HASS once.
+        """
+        # use what is known of the entities in the registry, over HASS state
+        record = self.registry.entities.get(sensor)
+        if record is None:
+            record = self.registry.add_entity(sensor)
+
+        if not record.exists and not self.load_hass_record(record):
             self.adapi.log(
                 f"Entity {sensor} does not exist, running arrival scan.", level="ERROR"
             )
             self.adapi.run_in(self.run_arrive_scan, 0)
             return
 
-        sensor_state = self.hass.get_state(sensor, attribute="all")
-        state = sensor_state.get("state")
-        attributes = sensor_state.get("attributes", {})
         if new_state is None:
-            update_needed = False
-            new_state = state
-        else:
-            update_needed = state != new_state
+            new_state = record.state
 
+        attributes = record.attributes
         if isinstance(new_attr, dict):
+            attributes = dict(attributes)
             attributes.update(new_attr)
-            update_needed = True
 
-        if update_needed:
+        if new_state == record.state and attributes == record.attributes:
+            # nothing has changed, so no need to write it
+            self.suppressed_writes += 1
+            return
+
+        if sensor in self.pending_writes:
+            # merged into the write already pending
+            self.suppressed_writes += 1
+
+        else:
+            # keep what HASS has now, to diff against when flushing
+            self.pending_writes[sensor] = (record.state, record.attributes)
+
+        record.state = new_state
+        record.attributes = attributes
+
+        if self.write_window <= 0:
+            self.flush_hass_writes({})
+
+        elif self.write_timer is None:
+            self.write_timer = self.adapi.run_in(
+                self.flush_hass_writes, self.write_window
+            )
+
+    def flush_hass_writes(self, kwargs):
+        """Write all pending sensor updates to HASS."""
+        self.write_timer = None
+        pending_writes, self.pending_writes = self.pending_writes, dict()
+
+        for sensor, (state, attributes) in pending_writes.items():
+            record = self.registry.entities.get(sensor)
+            if record is None or not record.exists:
+                # the entity was removed, or lost when HASS restarted
+                continue
+
+            if record.state == state and record.attributes == attributes:
+                # changes within the window cancelled out
+                self.suppressed_writes += 1
+                continue
+
             self.adapi.log(
-                f"__function__: Entity_ID: {sensor}, new_state: {new_state}",
+                f"__function__: Entity_ID: {sensor}, new_state: {record.state}",
                 level="DEBUG",
             )
-            self.hass.set_state(sensor, state=new_state, attributes=attributes)
+            self.hass.set_state(sensor, state=record.state, attributes=record.attributes)
+            self.flushed_writes += 1
+
+    def update_write_stats(self, kwargs):
+        """Report the HASS write counters on the monitor entity."""
+        attributes = {
+            "flushed_writes": self.flushed_writes,
+            "suppressed_writes": self.suppressed_writes,
+        }
+        if attributes != self.reported_write_stats:
+            self.reported_write_stats = attributes
+            self.mqtt.set_state(self.monitor_entity, attributes=attributes)
+
+    def setup_performance_stats(self):
+        """Wrap the hot paths of the app, to collect performance stats."""
+        self.performance = stats = PerformanceStats()
+
+        def get_action(topic):
+            parsed = self.topic_cache.get(topic)
+            if parsed is None:
+                return "unknown"
+
+            route, fields = parsed
+            return route.action or "device"
+
+        self.presence_message = stats.time_messages(self.presence_message, get_action)
+
+        for name in TIMED_CALLBACKS:
+            setattr(self, name, stats.time_callback(name, getattr(self, name)))
+
+        for api in (self.adapi, self.hass, self.mqtt):
+            for name in ("get_state", "set_state", "entity_exists"):
+                setattr(api, name, stats.count_calls("store_calls", getattr(api, name)))
+
+        for name in ("run_in", "run_at", "run_every", "run_daily"):
+            setattr(
+                self.adapi,
+                name,
+                stats.count_calls("timers_started", getattr(self.adapi, name)),
+            )
+
+        self.adapi.cancel_timer = stats.count_calls(
+            "timers_cancelled", self.adapi.cancel_timer
+        )
+
+    def publish_performance(self, kwargs):
+        """Report the performance stats of the last interval."""
+        rate, attributes = self.performance.report()
+        self.performance.reset()
+
+        self.mqtt.set_state(
+            f"{self.monitor_name}.performance",
+            state=rate,
+            attributes=dict(
+                attributes,
+                unit_of_measurement="msg/s",
+                friendly_name="Monitor Performance",
+            ),
+            replace=True,
+        )
+        self.mqtt.mqtt_publish(
+            f"{self.monitor_topic}/performance", json.dumps(attributes)
+        )
+
+    def profile(self, kwargs):
+        """Profile the app for a number of seconds, and report where the time went."""
+        if self.profiling:
+            self.adapi.log("The app is already being profiled", level="WARNING")
+            return
+
+        self.profiling = True
+        duration = float(kwargs.get("duration", 30))
+        self.mqtt.set_state(
+            f"{self.monitor_name}.profile",
+            state="profiling",
+            attributes={"duration": duration, "friendly_name": "Monitor Profile"},
+        )
+
+        # sample from the executor, to not hold up a callback thread
+        self.adapi.submit_to_executor(
+            self.run_profiler,
+            duration,
+            float(kwargs.get("interval", 0.005)),
+            int(kwargs.get("top", 15)),
+        )
+
+    def run_profiler(self, duration, interval, top):
+        """Sample the app, then write the report and publish its summary."""
+        profile_file = self.args.get(
+            "profile_file",
+            os.path.join(tempfile.gettempdir(), f"{self.monitor_name}_profile.txt"),
+        )
+        profiler = SamplingProfiler(interval)
+
+        try:
+            profiler.run(duration)
+            with open(profile_file, "w") as report:
+                report.write(profiler.report())
+
+        except OSError as error:
+            self.adapi.log(f"Could not write the profile: {error}", level="WARNING")
+            profile_file = None
+
+        finally:
+            self.profiling = False
+
+        self.adapi.log(f"Profiled the app for {duration}s, report in {profile_file}")
+        self.mqtt.set_state(
+            f"{self.monitor_name}.profile",
+            state="idle",
+            attributes={
+                "duration": round(profiler.elapsed, 1),
+                "interval": interval,
+                "samples": profiler.samples,
+                "report": profile_file,
+                "top": profiler.top(top),
+            },
+        )
+
+    def load_hass_record(self, record):
+        """Load a registry record from HASS, if its entity exists."""
+        entity_state = self.hass.get_state(record.entity_id, attribute="all")
+        if not entity_state:
+            return False
+
+        record.load(entity_state)
+        return True
 
     def motion_detected(self, entity, attribute, old, new, kwargs):
         """Respond to motion detected somewhere in the house.
@@ -882,44 +2362,86 @@ class HomePresenceApp(ad.ADBase):
         """
         self.adapi.log(f"Motion Sensor {entity} now {new}", level="DEBUG")
 
+        self.last_motion = self.adapi.datetime()
+        if self.next_scan is not None and self.next_scan > self.last_motion + timedelta(
+            seconds=self.scan_interval_min
+        ):
+            # someone is moving about, so could be leaving soon
+            self.schedule_adaptive_scan(self.scan_interval_min)
+
+        # ignore a sensor that keeps detecting motion
+        now = time.monotonic()
+        last_motion = self.motion_sensor_times.get(entity)
+        if last_motion is not None and now - last_motion < self.args.get(
+            "rssi_sensor_cooldown", 30
+        ):
+            return
+
+        self.motion_sensor_times[entity] = now
+
+        # a motion sensor without nodes, means all nodes have to scan
+        for room in self.motion_nodes.get(entity, [None]):
+            self.rssi_rooms.setdefault(room, now)
+
+        self.run_motion_rssi_scans({})
+
+    def run_motion_rssi_scans(self, kwargs):
+        """Request RSSI Scans for the rooms with motion, as the rate limit allows.
+
+        Scans are limited by a token bucket, refilled at rssi_scan_rate scans
+        a minute and holding up to rssi_scan_burst. A room waiting longer than
+        rssi_timeout is scanned regardless, so its never more stale than that.
+        """
         if self.motion_timer is not None and self.adapi.timer_running(
             self.motion_timer
-        ):  # a timer is running already
+        ):
             self.adapi.cancel_timer(self.motion_timer)
-            self.motion_timer = None
-        """ 'duration' parameter could be used in listen_state.
-            But need to use a single timer for all motion sensors,
-            to avoid running the scan too many times"""
-        self.motion_timer = self.adapi.run_in(
-            self.run_rssi_scan, self.args.get("rssi_timeout", 60)
-        )
 
-    def check_home_state(self, kwargs):
-        """Check if a user is home based on multiple locations."""
+        self.motion_timer = None
+        now = time.monotonic()
+        rate = self.args.get("rssi_scan_rate", 2) / 60
+        burst = self.args.get("rssi_scan_burst", 3)
+        max_staleness = self.args.get("rssi_timeout", 60)
 
-        self.check_home_timer = None
-        check_state = kwargs["check_state"]
-        user_res = list(
-            map(lambda x: self.hass.get_state(x, copy=False), self.all_users_sensors)
-        )
-        user_res = [i for i in user_res if i is not None and i != "unknown"]
-        somebody_home = "on"
+        self.rssi_tokens = min(burst, self.rssi_tokens + (now - self.rssi_refilled) * rate)
+        self.rssi_refilled = now
 
-        if check_state == "is_home" and all(
-            list(map(lambda x: x in ["on", "home"], user_res))
-        ):
-            # Someone is home, check if everyone is home.
-            self.update_hass_sensor(self.everyone_home, "on")
-        elif check_state == "not_home" and all(
-            list(map(lambda x: x in ["off", "not_home"], user_res))
-        ):
-            # Someone is not home, see if anyone is still home.
-            self.update_hass_sensor(self.everyone_not_home, "on")
-            somebody_home = "off"
+        if None in self.rssi_rooms:
+            # all nodes will be scanning, so no room has to wait on its own
+            self.rssi_rooms = {None: min(self.rssi_rooms.values())}
 
-        count = self.count_persons_in_home()
-        new_attr = {"count": count}
-        self.update_hass_sensor(self.somebody_is_home, somebody_home, new_attr=new_attr)
+        for room, since in sorted(self.rssi_rooms.items(), key=lambda item: item[1]):
+            if self.rssi_tokens < 1 and now - since < max_staleness:
+                continue
+
+            self.rssi_tokens = max(self.rssi_tokens - 1, 0)
+            del self.rssi_rooms[room]
+            self.run_rssi_scan({"location": room})
+
+        if not self.rssi_rooms:
+            return
+
+        # try again once there is a token, or a room can't wait any longer
+        wait = max_staleness - (now - min(self.rssi_rooms.values()))
+        if rate:
+            wait = min(wait, (1 - self.rssi_tokens) / rate)
+
+        self.motion_timer = self.adapi.run_in(self.run_motion_rssi_scans, max(wait, 1))
+
+    def update_occupancy_sensors(self):
+        """Update the global home sensors from the occupancy counters."""
+        home = self.registry.home
+        away = self.registry.away
+
+        everyone_home = "on" if home > 0 and away == 0 else "off"
+        everyone_not_home = "on" if home == 0 and away > 0 else "off"
+        somebody_home = "on" if home > 0 else "off"
+
+        self.update_hass_sensor(self.everyone_home, everyone_home)
+        self.update_hass_sensor(self.everyone_not_home, everyone_not_home)
+        self.update_hass_sensor(
+            self.somebody_is_home, somebody_home, new_attr={"count": home}
+        )
 
     def reload_device_state(self, kwargs):
         """Get the latest states from the scanners."""
@@ -928,27 +2450,20 @@ class HomePresenceApp(ad.ADBase):
             self.send_mqtt_message, 0, topic=topic, payload="", scan_type="System"
         )
 
-    def monitor_changed_state(self, entity, attribute, old, new, kwargs):
-        """Respond to a monitor location changing state."""
-        scan = kwargs["scan"]
-        topic = kwargs["topic"]
-        payload = kwargs["payload"]
-        self.adapi.run_in(
-            self.send_mqtt_message, 1, topic=topic, payload=payload, scan_type="Arrive"
-        )  # Send to scan for arrival of anyone
-        self.adapi.cancel_listen_state(self.monitor_handlers[scan])
-        self.monitor_handlers[scan] = None
-
     def forward_monitor_state(self, entity, attribute, old, new, kwargs):
-        """Respond to any changes in the monitor system or each node"""
-        new_state = copy.deepcopy(new)
-        data = new_state["attributes"]
+        """Respond to any changes in the monitor system or each node.
+
+        In delta mode, the changes within the forward window are merged and
+        only the fields that changed are published.
+        """
+        # the values are replaced on change, never modified, so a shallow
+        # copy is enough to serialise it later
+        data = dict(new["attributes"])
 
         # clean the data
-        data.pop("friendly_name")
-        last_changed = new_state["last_changed"]
-        state = new_state["state"]
-        data.update({"last_changed": last_changed, "state": state})
+        data.pop("friendly_name", None)
+        data["last_changed"] = new["last_changed"]
+        data["state"] = new["state"]
 
         if "location" not in data:  # it belongs to the overall monitor system
             topic = f"{self.monitor_topic}/state"
@@ -957,7 +2472,63 @@ class HomePresenceApp(ad.ADBase):
             location = data["location"].lower().replace(" ", "_")
             topic = f"{self.monitor_topic}/{location}/state"
 
-        self.mqtt.mqtt_publish(topic, json.dumps(data))
+        if not self.state_delta:
+            self.mqtt.mqtt_publish(topic, json.dumps(data))
+            return
+
+        self.forward_states[topic] = data
+
+        if self.forward_window <= 0:
+            self.flush_state_forwards({})
+
+        elif self.forward_timer is None:
+            self.forward_timer = self.adapi.run_in(
+                self.flush_state_forwards, self.forward_window
+            )
+
+    def flush_state_forwards(self, kwargs):
+        """Publish the fields of the monitor states changed since last sent."""
+        self.forward_timer = None
+
+        for topic, data in self.forward_states.items():
+            forwarded = self.forwarded_states.get(topic)
+            if forwarded is None:
+                # never sent, so the subscribers need all of it
+                self.publish_state_snapshot(topic, data)
+                continue
+
+            if forwarded is data:
+                continue
+
+            delta = {
+                key: value
+                for key, value in data.items()
+                if key not in forwarded or forwarded[key] != value
+            }
+
+            # fields removed are sent as null
+            delta.update((key, None) for key in forwarded if key not in data)
+
+            self.forwarded_states[topic] = data
+            if delta:
+                self.mqtt.mqtt_publish(topic, json.dumps(delta))
+
+    def publish_state_snapshots(self, kwargs):
+        """Publish the full monitor states, retained."""
+        if self.forward_timer is not None:
+            # changes waiting are part of the snapshots
+            self.adapi.cancel_timer(self.forward_timer)
+            self.forward_timer = None
+
+        for topic, data in self.forward_states.items():
+            if self.retained_states.get(topic) is not data:
+                self.publish_state_snapshot(topic, data)
+
+    def publish_state_snapshot(self, topic, data):
+        """Publish the full state on a monitor state topic, retained."""
+        self.forwarded_states[topic] = data
+        self.retained_states[topic] = data
+        self.mqtt.mqtt_publish(topic, json.dumps(data), retain=True)
 
     def gateway_opened(self, entity, attribute, old, new, kwargs):
         """Respond to a gateway device opening or closing."""
@@ -979,110 +2550,362 @@ class HomePresenceApp(ad.ADBase):
         if state is None:
             # none sent, so its a timer and so need to get the data itself, what a drag
 
-            states = []
-            for gateway_sensor in self.args.get("home_gateway_sensors", []):
-                (namespace, sensor) = self.parse_sensor(gateway_sensor)
-                states.append(self.adapi.get_state(x, copy=False, namespace=namespace))
+            states = []
+            for gateway_sensor in self.args.get("home_gateway_sensors", []):
+                (namespace, sensor) = self.parse_sensor(gateway_sensor)
+                states.append(self.adapi.get_state(x, copy=False, namespace=namespace))
+
+            # now check if any of them is opened
+            for s in states:
+                if s in true_states:
+                    state = s
+                    break
+
+        if state not in (true_states + false_states):
+            return
+
+        if self.gateway_timer is not None and self.adapi.timer_running(
+            self.gateway_timer
+        ):
+            # Cancel Existing Timer
+            self.adapi.cancel_timer(self.gateway_timer)
+            self.gateway_timer = None
+
+        if self.registry.home == 0 and self.registry.away > 0:
+            # No one at home
+            self.adapi.run_in(self.run_arrive_scan, 0)
+
+        elif self.registry.home > 0 and self.registry.away == 0:
+            # everyone at home
+            self.adapi.run_in(self.run_depart_scan, 0)
+
+        else:
+            self.adapi.run_in(self.run_arrive_scan, 0)
+            self.adapi.run_in(self.run_depart_scan, 0)
+
+        # now check if gateway opned and the user had declared a scan interval for gateway opened
+        if state in true_states and self.args.get("gateway_scan_interval"):
+            timer = int(self.args.get("gateway_scan_interval"))
+            first_time = kwargs.get("first_time", True)
+            # there is a scan interval so need to be worked on
+            # but first check if there is an initial one and it hasn't been ran
+            if first_time and self.args.get("gateway_scan_interval_delay"):
+                timer = int(self.args.get("gateway_scan_interval_delay"))
+                first_time = False
+
+            self.adapi.run_in(self.gateway_opened_timer, timer, first_time=first_time)
+
+    def run_arrive_scan(self, kwargs):
+        """Request an arrival scan.
+
+        Will wait for the scanner to be free and then sends the message.
+        """
+        for location in self.scan_locations(kwargs.get("location")):
+            self.request_scan("arrive", kwargs.get("priority"), location)
+
+    def run_depart_scan(self, kwargs):
+        """Request a departure scan.
+
+        Will wait for the depart check time, and then for the scanner to be
+        free before sending the message.
+        """
+        delay = kwargs.get("scan_delay", self.depart_check_time)
+        count = kwargs.get("count", 1)
+
+        for location in self.scan_locations(kwargs.get("location")):
+            if location is None:
+                timer = self.gateway_timer
+            else:
+                timer = self.depart_timers.get(location)
+
+            # Cancel any timers
+            if timer is not None and self.adapi.timer_running(timer):
+                self.adapi.cancel_timer(timer)
+
+            # Scan for departure of anyone
+            timer = self.adapi.run_in(
+                self.queue_depart_scan,
+                delay,
+                count=count,
+                priority=kwargs.get("priority"),
+                location=location,
+            )
+
+            if location is None:
+                self.gateway_timer = timer
+            else:
+                self.depart_timers[location] = timer
+
+    def queue_depart_scan(self, kwargs):
+        """Queue a departure scan, once the depart check time elapsed."""
+        location = kwargs["location"]
+        if location is None:
+            # Last Gateway Based Timer
+            self.gateway_timer = None
+        else:
+            self.depart_timers.pop(location, None)
+
+        self.request_scan(
+            "depart", kwargs.get("priority"), location, count=kwargs["count"]
+        )
+
+    def scan_locations(self, location):
+        """Get the nodes a scan is for, with None meaning all nodes."""
+        if location is None or location == "all":
+            return [None]
+
+        return self.parse_locations(location) or [None]
+
+    def parse_locations(self, location):
+        """Get the nodes of a location, given as a node, a list of nodes or
+        nodes separated by commas."""
+        if isinstance(location, str):
+            location = location.split(",")
+
+        locations = [str(loc).strip().lower().replace(" ", "_") for loc in location]
+        return [loc for loc in locations if loc]
+
+    def request_scan(self, scan_type, priority=None, location=None, **kwargs):
+        """Queue a scan for a node, or all nodes, to be sent once they are idle.
+
+        A scan of a type already waiting for the same nodes is merged with it,
+        keeping the higher priority and when it was first requested. A scan
+        for all nodes replaces those waiting for single nodes.
+        """
+        if priority is None:
+            priority = SCAN_PRIORITIES[scan_type]
+
+        if (scan_type, None) in self.scan_queue:
+            location = None  # all nodes will be scanning anyway
+
+        elif location is None:
+            for key in [key for key in self.scan_queue if key[0] == scan_type]:
+                request = self.scan_queue.pop(key)
+                priority = min(priority, request["priority"])
+
+        key = (scan_type, location)
+        request = self.scan_queue.get(key)
+        if request is None:
+            self.scan_queue[key] = {
+                "priority": priority,
+                "requested": time.monotonic(),
+                "kwargs": kwargs,
+            }
+
+        else:
+            request["priority"] = min(request["priority"], priority)
+            if "count" in kwargs:
+                # a new depart scan restarts the repeated scans
+                request["kwargs"]["count"] = min(
+                    request["kwargs"].get("count", 1), kwargs["count"]
+                )
+
+        self.dispatch_scan()
 
-            # now check if any of them is opened
-            for s in states:
-                if s in true_states:
-                    state = s
-                    break
+    def dispatch_scan(self):
+        """Send the scans waiting with the highest priority, to the nodes idle.
 
-        if state not in (true_states + false_states):
+        A scan for all nodes waits for all of them to be idle, and scans with
+        a lower priority wait behind it.
+        """
+        if not self.scan_queue:
+            self.report_scan_queue()
             return
 
-        if self.gateway_timer is not None and self.adapi.timer_running(
-            self.gateway_timer
-        ):
-            # Cancel Existing Timer
-            self.adapi.cancel_timer(self.gateway_timer)
-            self.gateway_timer = None
+        now = time.monotonic()
+        start_timeout = self.args.get("scan_start_timeout", 5)
+        for location, sent in list(self.scan_sent.items()):
+            if now - sent >= start_timeout:
+                # it never started, so the node is taken as idle
+                self.scan_sent.pop(location)
+
+        busy = set(self.mqtt.get_state(self.monitor_entity, attribute="locations") or [])
+        busy.update(self.scan_sent)
+        requests = sorted(
+            self.scan_queue.items(),
+            key=lambda item: (item[1]["priority"], item[1]["requested"]),
+        )
 
-        if self.hass.get_state(self.everyone_not_home, copy=False) == "on":
-            # No one at home
-            self.adapi.run_in(self.run_arrive_scan, 0)
+        for (scan_type, location), request in requests:
+            if busy and (location is None or location in busy or None in busy):
+                if location is None:
+                    break
 
-        elif self.hass.get_state(self.everyone_home, copy=False) == "on":
-            # everyone at home
-            self.adapi.run_in(self.run_depart_scan, 0)
+                continue
 
+            self.scan_queue.pop((scan_type, location))
+            self.send_scan(scan_type, location, request)
+            busy.add(location)
+
+        self.report_scan_queue()
+        if self.scan_queue:
+            self.arm_scan_guard()
+
+    def report_scan_queue(self):
+        """Report the number of scans waiting, when it changed."""
+        depth = len(self.scan_queue)
+        if depth != self.scan_queue_reported:
+            self.scan_queue_reported = depth
+            self.mqtt.set_state(self.monitor_entity, scan_queue=depth)
+
+    def send_scan(self, scan_type, location, request):
+        """Send a scan to a node, or all nodes."""
+        if location is None:
+            topic = f"{self.monitor_topic}/scan/{scan_type}"
         else:
-            self.adapi.run_in(self.run_arrive_scan, 0)
-            self.adapi.run_in(self.run_depart_scan, 0)
+            topic = f"{self.monitor_topic}/{location}/scan/{scan_type}"
 
-        # now check if gateway opned and the user had declared a scan interval for gateway opened
-        if state in true_states and self.args.get("gateway_scan_interval"):
-            timer = int(self.args.get("gateway_scan_interval"))
-            first_time = kwargs.get("first_time", True)
-            # there is a scan interval so need to be worked on
-            # but first check if there is an initial one and it hasn't been ran
-            if first_time and self.args.get("gateway_scan_interval_delay"):
-                timer = int(self.args.get("gateway_scan_interval_delay"))
-                first_time = False
+        self.mqtt.mqtt_publish(topic, "")
+        self.count_scan()
+        self.scan_sent[location] = time.monotonic()
 
-            self.adapi.run_in(self.gateway_opened_timer, timer, first_time=first_time)
+        wait = self.scan_sent[location] - request["requested"]
+        self.scans_dispatched += 1
+        self.scan_wait_total += wait
+        self.mqtt.set_state(
+            self.monitor_entity,
+            scan_wait=round(wait, 3),
+            scan_wait_avg=round(self.scan_wait_total / self.scans_dispatched, 3),
+        )
 
-    def run_arrive_scan(self, kwargs):
-        """Request an arrival scan.
+        count = request["kwargs"].get("count")
+        if count is not None and count <= self.args.get("depart_scans", 3):
+            # Scan for departure times. 3 as default
+            self.adapi.run_in(
+                self.run_depart_scan, 0, count=count + 1, location=location
+            )
 
-        Will wait for the scanner to be free and then sends the message.
-        """
-        topic = f"{self.monitor_topic}/scan/arrive"
-        payload = ""
-        if self.mqtt.get_state(self.monitor_entity, copy=False) == "idle":
-            self.mqtt.mqtt_publish(topic, payload)
+    def arm_scan_guard(self):
+        """Check the scans waiting again, once a scan should have started or ended."""
+        now = time.monotonic()
+        start_timeout = self.args.get("scan_start_timeout", 5)
+        scan_timeout = self.args.get("scan_timeout", 120)
+
+        waits = [start_timeout - (now - sent) for sent in self.scan_sent.values()]
+        waits.extend(
+            scan_timeout - (now - since) for since in self.scanning_since.values()
+        )
+
+        if self.scan_guard is not None and self.adapi.timer_running(self.scan_guard):
+            self.adapi.cancel_timer(self.scan_guard)
+
+        wait = min(waits) if waits else start_timeout
+        self.scan_guard = self.adapi.run_in(self.check_stale_scan, max(wait, 1))
+
+    def check_stale_scan(self, kwargs):
+        """Free the nodes that never reported the end of their scan."""
+        self.scan_guard = None
+        if not self.scan_queue:
             return
 
-        # Scanner busy. Wait for it to finish:
-        scan_type = self.mqtt.get_state(
-            self.monitor_entity, attribute="scan_type", copy=False
-        )
-        if self.monitor_handlers.get("Arrive Scan") is None and scan_type != "arrival":
-            self.monitor_handlers["Arrive Scan"] = self.mqtt.listen_state(
-                self.monitor_changed_state,
-                self.monitor_entity,
-                new="idle",
-                old="scanning",
-                scan="Arrive Scan",
-                topic=topic,
-                payload=payload,
+        scan_timeout = self.args.get("scan_timeout", 120)
+        stale = [
+            location
+            for location, since in self.scanning_since.items()
+            if time.monotonic() - since >= scan_timeout
+        ]
+
+        if stale:
+            self.adapi.log(
+                f"Scan by {stale} did not end within {scan_timeout} seconds,"
+                " so sending the scans waiting",
+                level="WARNING",
             )
 
-    def run_depart_scan(self, kwargs):
-        """Request a departure scan.
+            scan_type = self.mqtt.get_state(self.monitor_entity, attribute="scan_type")
+            for location in stale:
+                self.handle_scanning("end", location, scan_type)
 
-        Will wait for the scanner to be free and then sends the message.
+            return  # handle_scanning sent the scans waiting
+
+        self.dispatch_scan()
+
+    def run_adaptive_scan(self, kwargs):
+        """Run the arrive and depart scans needed, when there are no gateway sensors.
+
+        Arrive scans are only needed if someone could arrive, and depart
+        scans if someone could depart. The next ones are then scheduled.
         """
-        delay = kwargs.get("scan_delay", self.depart_check_time)
-        count = kwargs.get("count", 1)
+        self.scan_timer = None
+        if self.registry.away > 0 or self.registry.home == 0:
+            self.run_arrive_scan({})
+
+        if self.registry.home > 0:
+            self.run_depart_scan({})
+
+        self.schedule_adaptive_scan(self.adaptive_scan_interval())
+
+    def schedule_adaptive_scan(self, interval):
+        """Schedule the next adaptive scan in interval seconds."""
+        if self.scan_timer is not None and self.adapi.timer_running(self.scan_timer):
+            self.adapi.cancel_timer(self.scan_timer)
+
+        self.scan_timer = self.adapi.run_in(self.run_adaptive_scan, interval)
+        self.next_scan = self.adapi.datetime() + timedelta(seconds=interval)
+
+        # now report the scans made in the last hour, and how often they are ran
+        self.count_scan(0)
+        attributes = {"scan_interval": interval, "scans_per_hour": len(self.scan_times)}
+        current = self.mqtt.get_state(self.monitor_entity, attribute="all")
+        if any(current["attributes"].get(k) != v for k, v in attributes.items()):
+            self.mqtt.set_state(self.monitor_entity, attributes=attributes)
+
+    def adaptive_scan_interval(self):
+        """Get the seconds till the next scan, from the activity in the home.
+
+        Recent motion, arrivals or departures give the floor, as others often
+        follow. Otherwise arrivals and departures usually happening at this
+        hour of the day bring it closer to the floor, half as much when nobody
+        is home, as then only arrivals can be missed. No activity gives the
+        ceiling.
+        """
+        now = self.adapi.datetime()
+        recent = [
+            last
+            for last in (self.last_motion, self.last_presence_change)
+            if last is not None
+            and now - last < timedelta(seconds=self.scan_interval_max)
+        ]
+        if recent:
+            activity = 1.0
 
-        topic = f"{self.monitor_topic}/scan/depart"
-        payload = ""
+        else:
+            busiest = max(self.presence_history)
+            activity = self.presence_history[now.hour] / busiest if busiest else 0.0
+            if self.registry.home == 0:
+                activity /= 2
 
-        # Cancel any timers
-        if self.gateway_timer is not None and self.adapi.timer_running(
-            self.gateway_timer
+        interval = self.scan_interval_max - activity * (
+            self.scan_interval_max - self.scan_interval_min
+        )
+        return int(max(self.scan_interval_min, interval))
+
+    def record_presence_change(self):
+        """Record a device arriving or departing, by the hour of day."""
+        self.last_presence_change = self.adapi.datetime()
+        self.presence_history[self.last_presence_change.hour] += 1
+
+        if self.next_scan is not None and self.next_scan > (
+            self.last_presence_change + timedelta(seconds=self.scan_interval_min)
         ):
-            self.adapi.cancel_timer(self.gateway_timer)
+            # others in the home often follow, so scan again sooner
+            self.schedule_adaptive_scan(self.scan_interval_min)
 
-        # Scan for departure of anyone
-        self.gateway_timer = self.adapi.run_in(
-            self.send_mqtt_message,
-            delay,
-            topic=topic,
-            payload=payload,
-            scan_type="Depart",
-            count=count,
-        )
+    def decay_presence_history(self, kwargs):
+        """Fade the older arrivals and departures, so the history follows routines."""
+        self.presence_history = [count * 0.8 for count in self.presence_history]
+
+    def count_scan(self, scans=1):
+        """Count a scan sent to the nodes, keeping those of the last hour."""
+        now = time.monotonic()
+        self.scan_times.extend([now] * scans)
+        while self.scan_times and now - self.scan_times[0] > 3600:
+            self.scan_times.popleft()
 
     def run_rssi_scan(self, kwargs):
-        """Send a RSSI Scan Request."""
-        topic = f"{self.monitor_topic}/scan/rssi"
-        payload = ""
-        self.mqtt.mqtt_publish(topic, payload)
-        self.motion_timer = None
+        """Request a RSSI Scan."""
+        for location in self.scan_locations(kwargs.get("location")):
+            self.request_scan("rssi", kwargs.get("priority"), location)
 
     def restart_device(self, kwargs):
         """Send a restart command to the monitor services."""
@@ -1138,22 +2961,22 @@ class HomePresenceApp(ad.ADBase):
                     self.mqtt.set_state(entity_id, reboot_scheduled="off")
 
                 try:
-                    # use executor here, as sometimes due to being unable to process it
-                    # as the node might be busy, could lead to AD hanging
-
-                    node_task = self.node_executing.get(node)
-                    if node_task is None or node_task.done() or node_task.cancelled():
-                        # meaning its either not running, or had completed or cancelled
-                        self.node_executing[node] = self.adapi.submit_to_executor(
-                            self.restart_hardware, node
-                        )
+                    with self.command_lock:
+                        rebooting = node in self.node_rebooting or (
+                            None,
+                            None,
+                        ) in self.node_commands.get(node, ())
 
-                    else:
+                    if rebooting:
                         self.adapi.log(
-                            f"{location}'s node busy executing a command. So cannot execute this now",
+                            f"{location}'s node is already rebooting. So not rebooting it again",
                             level="WARNING",
                         )
 
+                    else:
+                        # the reboot runs once the commands queued before it completed
+                        self.queue_node_command(node, None, None)
+
                 except Exception as e:
                     self.adapi.error(
                         f"Could not restart {node}, due to {e}", level="ERROR"
@@ -1176,7 +2999,7 @@ class HomePresenceApp(ad.ADBase):
             node = location
 
         if node == "all":
-            nodes = list(self.args.get("remote_monitors", {}).keys())
+            nodes = [n for n in self.args.get("remote_monitors", {}) if n != "disable"]
 
         elif isinstance(node, list):
             nodes = location
@@ -1184,28 +3007,148 @@ class HomePresenceApp(ad.ADBase):
         else:
             nodes = [node]
 
-        # now execute the command
+        timeout = float(
+            kwargs.get("timeout", self.args.get("node_command_timeout", 30))
+        )
+
+        # now queue the command on each node
         for node in nodes:
             if node not in self.args["remote_monitors"]:
                 self.adapi.log(
-                    f"Node {node} not defined. So cannot reboot it", level="WARNING",
+                    f"Node {node} not defined. So cannot run command on it",
+                    level="WARNING",
                 )
 
                 continue
 
-            node_task = self.node_executing.get(node)
-            if node_task is None or node_task.done() or node_task.cancelled():
-                # meaning its either not running, or had completed or cancelled
-                self.node_executing[node] = self.adapi.submit_to_executor(
-                    self.execute_command, node, cmd
+            self.queue_node_command(node, cmd, timeout)
+
+    def queue_node_command(self, node, cmd, timeout):
+        """Queue a command on a node, to run once its earlier ones completed.
+
+        A command of None reboots the node. The commands queued after it wait
+        for the node to be back online.
+        """
+        with self.command_lock:
+            queue = self.node_commands.setdefault(node, deque())
+            queue.append((cmd, timeout))
+
+            if node in self.node_rebooting:
+                self.adapi.log(
+                    f"{node}'s node is rebooting, so queued {cmd} till its back online",
+                    level="DEBUG",
                 )
 
-            else:
+            elif not self.start_node_commands(node):
                 self.adapi.log(
-                    f"{location}'s node busy executing a command. So cannot execute this now",
-                    level="WARNING",
+                    f"{node}'s node busy executing a command, so queued"
+                    f" {cmd or 'a reboot'} behind {len(queue) - 1} others",
+                    level="DEBUG",
                 )
 
+    def start_node_commands(self, node):
+        """Run the commands queued on a node, unless they are already running.
+
+        Must be called holding the command lock.
+        """
+        node_task = self.node_executing.get(node)
+        if node_task is None or node_task.done() or node_task.cancelled():
+            # meaning its either not running, or had completed or cancelled
+            # use executor here, as the node being busy could lead to AD hanging
+            self.node_executing[node] = self.adapi.submit_to_executor(
+                self.run_node_commands, node
+            )
+            return True
+
+        return False
+
+    def resume_node_commands(self, node):
+        """Run the commands queued on a node while it rebooted."""
+        with self.command_lock:
+            if node not in self.node_rebooting:
+                return
+
+            self.node_rebooting.discard(node)
+            if self.node_commands.get(node):
+                self.start_node_commands(node)
+
+    def run_node_commands(self, node):
+        """Run the commands queued on a node, one after the other."""
+        while True:
+            with self.command_lock:
+                queue = self.node_commands.get(node)
+                if not queue or node in self.node_rebooting:
+                    self.node_executing[node] = None
+                    return
+
+                cmd, timeout = queue.popleft()
+
+            if cmd is not None:
+                self.run_queued_command(node, cmd, timeout)
+
+            elif self.restart_hardware(node):
+                # hold the commands left till the node is back online
+                with self.command_lock:
+                    self.node_rebooting.add(node)
+
+    def run_queued_command(self, node, cmd, timeout):
+        """Run a command on a node, and publish its result.
+
+        The output is published as it arrives too, in results with running set,
+        holding the lines received since the last one.
+        """
+        topic = f"{self.monitor_topic}/{node}/command_result"
+        interval = self.args.get("node_command_stream_interval", 1)
+        partial = {"stdout": "", "stderr": ""}  # lines not received in full yet
+        lines = {"stdout": [], "stderr": []}
+        published = [time.monotonic()]
+
+        def publish_output():
+            published[0] = time.monotonic()
+            if lines["stdout"] or lines["stderr"]:
+                self.mqtt.mqtt_publish(
+                    topic, json.dumps(dict(lines, command=cmd, running=True))
+                )
+                lines["stdout"], lines["stderr"] = [], []
+
+        def stream_output(stream, data):
+            received = (partial[stream] + data).split("\n")
+            partial[stream] = received.pop()
+            for line in received:
+                self.adapi.log(f"{node} {stream}: {line}", level="DEBUG")
+                lines[stream].append(line)
+
+            if time.monotonic() - published[0] >= interval:
+                publish_output()
+
+        started = time.monotonic()
+        result = {"command": cmd, "exit_code": None, "timed_out": False}
+        try:
+            result.update(
+                self.execute_command(
+                    node, cmd, timeout=timeout, on_output=stream_output
+                )
+            )
+
+        except Exception as error:
+            self.adapi.log(
+                f"Could not run {cmd} on {node}'s Hardware: {error}", level="WARNING"
+            )
+            result["error"] = str(error)
+
+        for stream, line in partial.items():
+            if line:
+                lines[stream].append(line)
+
+        publish_output()
+
+        tail = self.args.get("node_command_tail", 20)
+        result["stdout"] = result.get("stdout", [])[-tail:]
+        result["stderr"] = result.get("stderr", [])[-tail:]
+        result["duration"] = round(time.monotonic() - started, 3)
+
+        self.mqtt.mqtt_publish(topic, json.dumps(result))
+
     def restart_hardware(self, node):
         """Used to Restart the Hardware Monitor running in"""
 
@@ -1219,6 +3162,11 @@ class HomePresenceApp(ad.ADBase):
         location = node.replace("_", " ").title()
         try:
             result = self.execute_command(node, reboot_command)
+
+            # the node is rebooting, so its connection will be dead
+            with self.ssh_pool.lock:
+                self.ssh_pool.close(node)
+
             self.adapi.log(
                 f"{node}'s Hardware reset completed with result {result}",
                 level="DEBUG",
@@ -1235,59 +3183,62 @@ class HomePresenceApp(ad.ADBase):
             self.adapi.error(
                 f"Could not restart {location} Monitor Hardware", level="ERROR",
             )
+            return False
+
+        return True
 
-    def execute_command(self, node, cmd):
+    def execute_command(self, node, cmd, timeout=None, on_output=None):
         """Used to Run command on a Monitor Node"""
 
         self.adapi.log(f"Running {cmd} on {node}'s Hardware")
-        import paramiko
 
         # get the node's credentials
 
         if node not in self.args["remote_monitors"]:
             raise ValueError(f"Given Node {node}, has no specified credentials")
 
-        setting = self.args["remote_monitors"][node]
-        host = setting["host"]
-        username = setting["username"]
-        password = setting["password"]
-
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(
-            host,
-            username=username,
-            password=password,
-            timeout=float(self.system_timeout),
-        )
-        stdin, stdout, stderr = ssh.exec_command(cmd)
-        completed = stdout.readlines()
-        ssh.close()
+        try:
+            completed = self.ssh_pool.execute(
+                node, cmd, timeout=timeout, on_output=on_output
+            )
+        finally:
+            self.update_ssh_stats(node)
 
         self.adapi.log(completed, level="DEBUG")
-
-        # reset node task if completed
-        self.node_executing[node] = None
         return completed
 
+    def update_ssh_stats(self, node):
+        """Report the node's SSH connection stats on its state entity."""
+        stats = self.ssh_pool.node_stats(node)
+        entity_id = f"{self.monitor_name}.{node}_state"
+        self.mqtt.set_state(
+            entity_id,
+            ssh_connects=stats["connects"],
+            ssh_reuses=stats["reuses"],
+            ssh_failures=stats["failures"],
+        )
+
+    def evict_ssh_connections(self, kwargs):
+        """Close the SSH connections to the nodes that have been idle."""
+        self.ssh_pool.evict_idle(self.args.get("ssh_idle_timeout", 300))
+
     def run_location_clean(self, kwargs):
         """Check for if any location has data that had not been properly cleaned
         and carry out some cleaning"""
 
-        # first get all sensors, and lets start from there
-        monitor_sensors = list(self.mqtt.get_state(self.monitor_name).keys())
-
-        # next we go via the location data, and see if any location needs cleaning
-        for sensor in monitor_sensors:
-            if sensor == self.monitor_entity:
+        # only locations no longer in use need cleaning
+        for location in list(self.registry.locations):
+            if location in self.locations:
                 continue
 
-            sens = list(filter(lambda l: re.search(l, sensor), self.locations))
-            if len(sens) == 0:
-                # it means this sensor doesn't belong to a valid location
-                # so it needs to be removed
-                self.adbase.log(f"Removing sensor {sensor}", level="WARNING")
-                self.mqtt.remove_entity(sensor)
+            for record in self.registry.location_records(location):
+                if self.mqtt.entity_exists(record.appdaemon_entity):
+                    # it means this sensor doesn't belong to a valid location
+                    # so it needs to be removed
+                    self.adapi.log(
+                        f"Removing sensor {record.appdaemon_entity}", level="WARNING"
+                    )
+                    self.mqtt.remove_entity(record.appdaemon_entity)
 
     def clear_location_entities(self, kwargs):
         """Clear sensors from an offline location.
@@ -1305,16 +3256,14 @@ class HomePresenceApp(ad.ADBase):
         # remove the handler from dict
         self.location_timers.pop(location, None)
 
-        for _, entity_list in self.home_state_entities.items():
-            for sensor in entity_list:
-                if location in sensor:  # that sensor belongs to that location
-                    self.update_hass_sensor(sensor, 0)
-                    appdaemon_conf_sensor = self.hass_conf_sensor_to_appdaemon_conf(
-                        sensor
-                    )
-                    # set to "unknown" since it had been cleared
-                    self.mqtt.set_state(appdaemon_conf_sensor, state=0, rssi="unknown")
-                    self.update_hass_sensor(sensor, new_attr={"rssi": "unknown"})
+        for record in self.registry.location_records(location):
+            if record.handle is not None:
+                record.device.update_confidence(location, 0, self.minimum_conf)
+                self.update_hass_sensor(record.entity_id, 0)
+                # set to "unknown" since it had been cleared
+                self.mqtt.set_state(record.appdaemon_entity, state=0, rssi="unknown")
+                self.update_hass_sensor(record.entity_id, new_attr={"rssi": "unknown"})
+                self.update_nearest_monitor(record, "unknown")
 
         if location in self.location_timers:
             self.location_timers.pop(location)
@@ -1327,17 +3276,6 @@ class HomePresenceApp(ad.ADBase):
         if location in self.locations:
             self.locations.remove(location)
 
-    def hass_conf_sensor_to_appdaemon_conf(self, sensor):
-        """used to convert HASS confidence sensor to AD's"""
-
-        device_entity_prefix = sensor.replace(
-            f"sensor.{self.monitor_name}_", ""
-        ).replace("_conf", "")
-
-        appdaemon_conf_sensor = f"{self.monitor_name}.{device_entity_prefix}"
-
-        return appdaemon_conf_sensor
-
     def node_state_changed(self, entity, attribute, old, new, kwargs):
         """Respond to a change in the Node's state."""
 
@@ -1426,20 +3364,96 @@ class HomePresenceApp(ad.ADBase):
                     )
 
                 else:
-                    # send a ping to node and log the output for debugging
-                    host = self.args["remote_monitors"][node]["host"]
+                    # check if the node can still be reached over the network
+                    self.probe_node(node, entity)
+
+    def probe_node(self, node, entity):
+        """Check if an offline node can be reached, without blocking the callback."""
+        result = self.reachability.get(node)
+        if result is not None and time.monotonic() - result["checked"] < self.args.get(
+            "reachability_cache_time", 30
+        ):
+            self.report_reachability(entity, result)
+            return
+
+        if node in self.probing:  # already being probed
+            return
+
+        self.probing.add(node)
+        self.adapi.submit_to_executor(self.check_reachability, node, entity)
+
+    def check_reachability(self, node, entity):
+        """Probe a node with a ping and/or connecting to its SSH port."""
+        setting = self.args["remote_monitors"][node]
+        probe = self.args.get("reachability_probe", "ping")
+        rtt = None
+
+        try:
+            if probe in ("ping", "both"):
+                rtt = self.ping_host(setting["host"])
+
+            if rtt is None and probe in ("tcp", "both"):
+                rtt = self.connect_host(setting["host"], setting.get("port", 22))
+
+        finally:
+            self.probing.discard(node)
+
+        result = {"checked": time.monotonic(), "reachable": rtt is not None, "rtt": rtt}
+        self.reachability[node] = result
+
+        self.adapi.log(f"Probed {node}'s reachability: {result}", level="DEBUG")
+        self.report_reachability(entity, result)
+
+    def ping_host(self, host):
+        """Ping a host, and return its round trip time in ms if it replied."""
+        timeout = self.args.get("reachability_timeout", 2)
+        try:
+            completed = subprocess.run(
+                ["ping", "-c1", f"-w{timeout}", host],
+                capture_output=True,
+                text=True,
+                timeout=timeout + 1,
+            )
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+
+        if completed.returncode != 0:
+            return None
+
+        match = re.search(r"time[=<]([\d.]+)", completed.stdout)
+        return float(match.group(1)) if match else 0.0
+
+    def connect_host(self, host, port):
+        """Connect to a host's port, and return the time it took in ms if it did."""
+        started = time.monotonic()
+        try:
+            with socket.create_connection(
+                (host, port), timeout=self.args.get("reachability_timeout", 2)
+            ):
+                pass
+        except OSError:
+            return None
+
+        return round((time.monotonic() - started) * 1000, 3)
 
-                    import subprocess
+    def report_reachability(self, entity, result):
+        """Report the result of probing a node on its state entity."""
+        rtt = result["rtt"] if result["reachable"] else "unknown"
 
-                    status, result = subprocess.getstatusoutput(f"ping -c1 -w2 {host}")
+        if (
+            not result["reachable"]
+            and self.mqtt.get_state(entity, copy=False) == "offline"
+        ):  # it is offline
+            self.mqtt.set_state(entity, state="network disconnected", rtt=rtt)
 
-                    if status == 1:  # it is offline
-                        self.mqtt.set_state(entity, state="network disconnected")
+        else:
+            self.mqtt.set_state(entity, rtt=rtt)
 
     def monitor_scan_now(self, entity, attribute, old, new, kwargs):
         """Request an immediate scan from the monitors."""
         scan_type = self.mqtt.get_state(entity, attribute="scan_type", copy=False)
-        locations = self.mqtt.get_state(entity, attribute="locations", copy=False)
+        # the nodes scanning are in locations, so the nodes to scan are apart
+        locations = self.mqtt.get_state(entity, attribute="scan_locations", copy=False)
 
         if scan_type == "both":
             self.adapi.run_in(self.run_arrive_scan, 0, location=locations)
@@ -1451,21 +3465,84 @@ class HomePresenceApp(ad.ADBase):
         elif scan_type == "depart":
             self.adapi.run_in(self.run_depart_scan, 0, location=locations)
 
-        self.mqtt.set_state(entity, state="idle")
+        self.mqtt.set_state(entity, state="idle", scan_locations=None)
 
     def load_known_devices(self, kwargs):
-        """Request all known devices in config to be added to monitors."""
-        timer = 0
-        if self.args.get("known_devices") is not None:
-            for device in self.args["known_devices"]:
-                self.adapi.run_in(
-                    self.send_mqtt_message,
-                    timer,
-                    topic=f"{self.monitor_topic}/setup/ADD STATIC DEVICE",
-                    payload=device,
-                    scan_type="System",
+        """Request all known devices in config to be added to monitors.
+
+        If a location is given, the devices are only sent to that node,
+        skipping those it already reported. They are sent in bursts, each
+        once the node acknowledged the previous one.
+        """
+        devices = self.args.get("known_devices", [])
+        location = kwargs.get("location")
+
+        if location is None:
+            for device in devices:
+                self.mqtt.mqtt_publish(
+                    f"{self.monitor_topic}/setup/ADD STATIC DEVICE", device
                 )
-                timer += 3
+            return
+
+        loader = self.device_loaders.get(location)
+        if (
+            loader is not None
+            and loader["timer"] is not None
+            and self.adapi.timer_running(loader["timer"])
+        ):
+            self.adapi.cancel_timer(loader["timer"])
+
+        reported = self.node_devices.get(location, set())
+        queue = [device for device in devices if device.split(" ", 1)[0] not in reported]
+        self.device_loaders[location] = {"queue": queue, "pending": 0, "timer": None}
+
+        self.adapi.log(
+            f"Loading {len(queue)} of {len(devices)} known devices to {location}",
+            level="DEBUG",
+        )
+        self.send_device_burst({"location": location})
+
+    def send_device_burst(self, kwargs):
+        """Send the next burst of known devices to a node."""
+        location = kwargs["location"]
+        loader = self.device_loaders.get(location)
+        if loader is None:
+            return
+
+        loader["timer"] = None
+        if not loader["queue"]:
+            # all sent, and acknowledged or timed out
+            del self.device_loaders[location]
+            self.provision_ack(location, "loaded")
+            return
+
+        burst = self.args.get("known_devices_burst", 0) or len(loader["queue"])
+        topic = f"{self.monitor_topic}/{location}/setup/ADD STATIC DEVICE"
+        for device in loader["queue"][:burst]:
+            self.mqtt.mqtt_publish(topic, device)
+
+        loader["pending"] = len(loader["queue"][:burst])
+        del loader["queue"][:burst]
+
+        # send the next one anyway, if the node doesn't acknowledge in time
+        loader["timer"] = self.adapi.run_in(
+            self.send_device_burst,
+            self.args.get("known_devices_burst_interval", 3),
+            location=location,
+        )
+
+    def device_loaded(self, location):
+        """Count a node acknowledging a known device, to send the next burst."""
+        loader = self.device_loaders.get(location)
+        if loader is None or loader["pending"] == 0:
+            return
+
+        loader["pending"] -= 1
+        if loader["pending"] == 0:
+            if self.adapi.timer_running(loader["timer"]):
+                self.adapi.cancel_timer(loader["timer"])
+
+            self.send_device_burst({"location": location})
 
     def remove_known_device(self, kwargs):
         """Request all known devices in config to be deleted from monitors."""
@@ -1482,118 +3559,224 @@ class HomePresenceApp(ad.ADBase):
             scan_type="System",
         )
 
-        # now remove the device from AD
-        entities = list(
-            self.mqtt.get_state(f"{self.monitor_name}", copy=False, default={}).keys()
-        )
-        device_name = None
-        for entity in entities:
-            if device == self.mqtt.get_state(entity, attribute="id", copy=False):
-                location = self.mqtt.get_state(entity, attribute="location")
-                if location is None:
-                    continue
+        for reported in self.node_devices.values():
+            reported.discard(device)
 
-                node = location.replace(" ", "_").lower()
-                self.mqtt.remove_entity(entity)
-                if device_name is None:
-                    _, domain_device = self.mqtt.split_entity(entity)
-                    device_name = domain_device.replace(f"_{node}", "")
+        device_records = self.registry.mac_devices(device)
+        if not device_records:
+            self.adapi.log(f"No entities found for device {device}", level="DEBUG")
 
-        # now remove the device from HA
-        entities = list(self.hass.get_state("sensor", copy=False, default={}).keys())
-        for entity in entities:
-            if device == self.hass.get_state(entity, attribute="id", copy=False):
-                # first cancel the handler if it exists
-                handler = self.confidence_handlers.get(entity)
-                if handler is not None:
-                    self.hass.cancel_listen_state(handler)
+        for device_record in device_records:
+            self.remove_device_entities(device_record)
 
-                self.hass.remove_entity(entity)
+    def remove_device_entities(self, device):
+        """Remove a device's entities from AD and HA, and stop listening to them."""
+        self.registry.remove_device(device.device_name)
 
-        if device_name is not None:
-            device_entity_id = f"{self.monitor_name}_{device_name}"
-            device_state_sensor = f"{self.user_device_domain}.{device_entity_id}"
+        timer = self.not_home_timers.pop(device.device_entity_id, None)
+        if timer is not None and self.adapi.timer_running(timer):
+            self.adapi.cancel_timer(timer)
+
+        for record in device.locations.values():
+            # first cancel the handler if it exists
+            if record.handle is not None:
+                self.hass.cancel_listen_state(record.handle)
+                record.handle = None
+
+            # now remove the device from AD
+            self.mqtt.remove_entity(record.appdaemon_entity)
+
+            # now remove the device from HA
+            if record.exists or self.hass.entity_exists(record.entity_id):
+                self.hass.remove_entity(record.entity_id)
 
-            if device_entity_id in self.home_state_entities:
-                del self.home_state_entities[device_entity_id]
+        if device.handle is not None:
+            self.mqtt.cancel_listen_state(device.handle)
+            device.handle = None
 
-            if device_state_sensor in self.all_users_sensors:
-                self.all_users_sensors.remove(device_state_sensor)
+        # now remove for HA
+        self.hass.remove_entity(device.entity_id)
 
-            # now remove for HA
-            self.hass.remove_entity(device_state_sensor)
+        # now remove for AD
+        self.mqtt.remove_entity(device.entity_id)
 
-            # now remove for AD
-            self.mqtt.remove_entity(device_state_sensor)
+        # the device no longer counts in the home's occupancy
+        if device.tracked:
+            self.update_occupancy_sensors()
 
     def clean_devices(self, kwargs):
-        """Used to check for old devices, and remove them accordingly"""
+        """Used to check for old devices, and remove them accordingly.
+
+        This (re)starts provisioning the nodes. The old devices are removed,
+        the nodes restarted if any was, then the known devices loaded and
+        their states synced. Each step starts as soon as the online nodes
+        acknowledged the previous one, or it timed out.
+        """
 
         # search for them first
-        delay = 0
         removed = []
         known_device_names = [n.lower() for n in list(self.known_devices.values())]
 
-        for sensor in self.mqtt.get_state(self.monitor_topic, copy=False, default={}):
-            mac_id = self.mqtt.get_state(sensor, attribute="id", copy=False)
-            if mac_id is None:
-                continue
-
-            sensor_name = self.mqtt.get_state(
-                sensor, attribute="name", copy=False, default=""
-            ).lower()
-            if mac_id not in removed and (
-                mac_id not in self.known_devices
-                or sensor_name not in known_device_names
+        for mac_id in list(self.registry.macs):
+            device_names = [
+                (device.name or "").lower()
+                for device in self.registry.mac_devices(mac_id)
+            ]
+            if mac_id not in self.known_devices or any(
+                name not in known_device_names for name in device_names
             ):
                 # it should be removed
+                removed.append(mac_id)
 
-                if removed == []:  # means haven't removed one yet
-                    self.adapi.log("Cleaning out old Known Devices")
+        self.provision_removed = removed
+        self.provision_queue = []
+        self.provision_started = self.adapi.datetime()
 
-                self.adapi.run_in(self.remove_known_device, delay, device=mac_id)
-                removed.append(mac_id)  # indicate it has been removed
-                delay += 3  # should process later
+        # wait for the nodes to report, unless all remote monitors already are
+        nodes = [
+            node
+            for node in self.args.get("remote_monitors", {})
+            if node != "disable" and self.node_states.get(node) != "online"
+        ]
+        timeout = self.args.get("provision_discovery_time", 5)
+        if not nodes and self.args.get("remote_monitors"):
+            timeout = 0
+
+        self.start_provision_step("discovering", 1, timeout, nodes=nodes)
 
-        if removed != []:
-            delay += 5
-            # means some where removed, so needs to re-load the scripts to clean properly
-            self.adapi.run_in(self.restart_device, delay)
+    def start_provision_step(self, step, acks, timeout, nodes=None):
+        """Start a provisioning step, expecting acks from each node.
 
-        # now load up the known devices before state
-        delay += 45
-        self.adapi.run_in(self.load_known_devices, delay)
+        The step times out after timeout seconds, and right away if there
+        are no nodes to wait for.
+        """
+        if self.provision_timer is not None and self.adapi.timer_running(
+            self.provision_timer
+        ):
+            self.adapi.cancel_timer(self.provision_timer)
 
-        if removed != []:
-            delay += 15 + len(known_device_names)
-            self.adapi.run_in(self.run_arrive_scan, delay)
-            self.adapi.run_in(self.load_known_devices, delay + 120)
+        if nodes is None:
+            nodes = self.online_nodes() if acks > 0 else []
+            if not nodes:
+                timeout = 0
 
-        delay += 60
-        self.adapi.run_in(self.reload_device_state, delay)
+        self.provision_step = step
+        self.provision_acks = {node: acks for node in nodes}
+        self.provision_timer = self.adapi.run_in(
+            self.provision_timeout, timeout, step=step
+        )
 
-        # for some strange reasons, forces the app to run load_known_devices twice
-        # to get updated data on the cleaned out devices
+        if self.mqtt.get_state(self.monitor_entity, attribute="provisioning") != step:
+            self.mqtt.set_state(self.monitor_entity, provisioning=step)
 
-    def count_persons_in_home(self):
-        """Used to count the number of persons in the Home"""
+    def provision_ack(self, location, action):
+        """Count an acknowledgement of the provisioning step from a node."""
+        if PROVISIONING_ACKS.get(self.provision_step) != action:
+            return
+
+        remaining = self.provision_acks.get(location)
+        if remaining is None:  # not waiting for this node
+            return
+
+        if remaining > 1:
+            self.provision_acks[location] = remaining - 1
+            return
+
+        del self.provision_acks[location]
+        if not self.provision_acks:
+            self.advance_provisioning()
+
+    def provision_timeout(self, kwargs):
+        """Move on provisioning, as the nodes did not acknowledge in time."""
+        if kwargs["step"] != self.provision_step:
+            return
+
+        self.provision_timer = None
+        if self.provision_acks:
+            self.adapi.log(
+                f"Provisioning step {self.provision_step} timed out waiting"
+                f" for {', '.join(self.provision_acks)}",
+                level="DEBUG",
+            )
+
+        self.advance_provisioning()
+
+    def advance_provisioning(self):
+        """Start the next provisioning step, once the current one is done."""
+        if self.provision_timer is not None and self.adapi.timer_running(
+            self.provision_timer
+        ):
+            self.adapi.cancel_timer(self.provision_timer)
+
+        self.provision_timer = None
+        step = self.provision_step
+
+        if step == "discovering" and self.provision_removed:
+            self.adapi.log("Cleaning out old Known Devices")
+            self.provision_queue = list(self.provision_removed)
+            step = "removing"
 
-        user_devices = list(self.home_state_entities.keys())
-        sensors = list(
-            map(
-                lambda x: self.mqtt.get_state(
-                    f"{self.user_device_domain}.{x}", copy=False
-                ),
-                user_devices,
+        if step == "removing":
+            if self.provision_queue:
+                # remove one device at a time, so as not to overload the nodes
+                self.remove_known_device({"device": self.provision_queue.pop(0)})
+                self.start_provision_step("removing", 1, 5)
+
+            else:
+                # some where removed, so needs to re-load the scripts to clean properly
+                self.restart_device({})
+                self.start_provision_step("restarting", 1, 45)
+
+        elif step in ("discovering", "restarting"):
+            # now load up the known devices before state
+            nodes = self.online_nodes()
+            burst = self.args.get("known_devices_burst", 0) or len(self.known_devices)
+            bursts = -(-len(self.known_devices) // max(burst, 1))
+            self.start_provision_step(
+                "loading",
+                1,
+                15 + bursts * self.args.get("known_devices_burst_interval", 3),
             )
-        )
-        sensors = [i for i in sensors if i == self.state_true]
 
-        return len(sensors)
+            if not nodes:
+                self.load_known_devices({})
+
+            for node in nodes:
+                self.load_known_devices({"location": node})
+
+        elif step == "loading":
+            self.reload_device_state({})
+            self.start_provision_step("syncing", 1, 60)
+
+        elif step == "syncing":
+            if self.provision_removed:
+                self.adapi.run_in(self.run_arrive_scan, 0)
+
+            time_to_ready = round(
+                (self.adapi.datetime() - self.provision_started).total_seconds(), 1
+            )
+            self.adapi.log(
+                f"Nodes provisioned in {time_to_ready} seconds", level="DEBUG"
+            )
+
+            self.provision_step = "ready"
+            self.provision_acks = dict()
+            self.mqtt.set_state(
+                self.monitor_entity, provisioning="ready", time_to_ready=time_to_ready
+            )
+
+    def count_persons_in_home(self):
+        """Used to count the number of persons in the Home"""
+
+        return self.registry.home
 
     def hass_restarted(self, event_name, data, kwargs):
         """Respond to a HASS Restart."""
+        # HASS would have lost the entities created by the app
+        self.pending_writes.clear()
+        self.registry.forget_hass_state()
         self.setup_global_sensors()
+        self.update_occupancy_sensors()
         # self.adapi.run_in(self.reload_device_state, 10)
         self.adapi.run_in(self.restart_device, 5)
 
@@ -1629,6 +3812,9 @@ class HomePresenceApp(ad.ADBase):
         self.mqtt.register_service(
             f"{self.monitor_name}/clean_devices", self.presense_services
         )
+        self.mqtt.register_service(
+            f"{self.monitor_name}/profile", self.presense_services
+        )
 
     def presense_services(self, namespace, domain, service, kwargs):
         """Callback for executing service call"""
@@ -1656,7 +3842,8 @@ class HomePresenceApp(ad.ADBase):
             return
 
         if "location" in kwargs:
-            kwargs["location"] = kwargs["location"].replace(" ", "_").lower()
+            locations = self.parse_locations(kwargs["location"])
+            kwargs["location"] = locations[0] if len(locations) == 1 else locations
 
         if "delay" in kwargs:
             scan_delay = kwargs.pop("delay")
@@ -1678,6 +3865,16 @@ class HomePresenceApp(ad.ADBase):
         return (namespace, sen)
 
     def terminate(self):
+        # write out any sensor updates still pending
+        self.flush_hass_writes({})
+
+        if self.snapshot_file is not None:
+            self.save_presence_snapshot({"wait": True})
+
+        # and monitor states not yet forwarded
+        if self.forward_timer is not None:
+            self.flush_state_forwards({})
+
         for node in self.node_executing:
             if self.node_executing[node] is not None:
                 if (
@@ -1686,3 +3883,8 @@ class HomePresenceApp(ad.ADBase):
                 ):
                     # this means its still running, so cancel the task
                     self.node_executing[node].cancel()
+
+        self.ssh_pool.close_all()
+
+        if self.capture is not None:
+            self.close_capture()
@@ -0,0 +1,448 @@
+"""In-process stand-ins for the AppDaemon APIs the Monitor App uses.
+
+They let the app run without AppDaemon, Home Assistant or a MQTT broker, on
+a virtual clock, to benchmark it and replay traffic to it offline. Only what
+the app uses is implemented, the way AppDaemon 4 behaves:
+
+- the AD, HASS and MQTT apis share a state store, with a namespace each
+- state listeners and events are dispatched after the current callback
+- timers and executor jobs run on the virtual clock, not in threads
+- messages the app publishes to MQTT are delivered back to it, as the broker
+  would for the topics it subscribes to
+
+Use ``install()`` before importing the app, so it uses these stand-ins.
+"""
+import collections
+import concurrent.futures
+import copy
+import datetime
+import heapq
+import itertools
+import logging
+import sys
+import time as real_time
+
+LOGGER = logging.getLogger("appdaemon_stub")
+LOGGER.addHandler(logging.NullHandler())
+
+
+class VirtualClock:
+    """A clock which only moves when told to, running what is due on the way."""
+
+    def __init__(self, start=None):
+        self.now = start or datetime.datetime(2026, 1, 1, 12, 0, 0)
+        self.seq = itertools.count()
+        self.timers = []
+        self.handles = dict()
+        self.pending = collections.deque()
+
+    def monotonic(self):
+        """Get the seconds of the clock, as time.monotonic() does."""
+        return self.now.timestamp()
+
+    def schedule(self, callback, when, interval, kwargs):
+        """Run a callback at a time, and then every interval if there is one."""
+        handle = f"timer_{next(self.seq)}"
+        self.handles[handle] = (callback, kwargs, interval)
+        heapq.heappush(self.timers, (max(when, self.now), next(self.seq), handle))
+        return handle
+
+    def cancel(self, handle):
+        """Cancel a timer."""
+        return self.handles.pop(handle, None) is not None
+
+    def dispatch(self, callback, *args):
+        """Run a callback once the current one has returned."""
+        self.pending.append((callback, args))
+
+    def run_pending(self):
+        """Run the callbacks dispatched, including those they dispatch."""
+        while self.pending:
+            callback, args = self.pending.popleft()
+            callback(*args)
+
+    def advance(self, seconds):
+        """Move the clock forward, running the timers due on the way."""
+        self.run_until(self.now + datetime.timedelta(seconds=seconds))
+
+    def run_until(self, until):
+        """Move the clock to a time, running the timers due on the way."""
+        self.run_pending()
+        while self.timers and self.timers[0][0] <= until:
+            when, _, handle = heapq.heappop(self.timers)
+            entry = self.handles.get(handle)
+            if entry is None:  # cancelled
+                continue
+
+            callback, kwargs, interval = entry
+            self.now = max(self.now, when)
+            if interval:
+                heapq.heappush(
+                    self.timers,
+                    (when + datetime.timedelta(seconds=interval), next(self.seq), handle),
+                )
+            else:
+                del self.handles[handle]
+
+            callback(dict(kwargs))
+            self.run_pending()
+
+        self.now = max(self.now, until)
+
+
+class VirtualTime:
+    """Stand-in for the time module, with monotonic() following a clock."""
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def monotonic(self):
+        return self.clock.monotonic()
+
+    def sleep(self, seconds):
+        self.clock.advance(seconds)
+
+    def __getattr__(self, name):
+        return getattr(real_time, name)
+
+
+class Environment:
+    """What the apis share: the clock, state store, listeners and the broker."""
+
+    def __init__(self, clock=None, loopback=True):
+        self.clock = clock or VirtualClock()
+        self.loopback = loopback
+        self.states = collections.defaultdict(dict)
+        self.state_listeners = collections.defaultdict(dict)
+        self.event_listeners = dict()
+        self.services = dict()
+        self.handles = itertools.count()
+        self.calls = collections.Counter()
+        self.published = collections.Counter()
+        self.published_bytes = 0
+        self.log_counts = collections.Counter()
+
+        # called with the topic and payload of every message the app publishes,
+        # to play the part of the nodes
+        self.responders = []
+
+        # called with the namespace, entity, old and new state of every write
+        self.watchers = []
+
+    def receive(self, topic, payload):
+        """Have the app receive a MQTT message, and run all it leads to now."""
+        self.deliver(topic, payload)
+        self.clock.run_pending()
+
+    def deliver(self, topic, payload):
+        """Deliver a MQTT message to the app, as the broker and plugin would."""
+        data = {"topic": topic, "payload": payload}
+        for namespace, event, callback, kwargs in list(self.event_listeners.values()):
+            if namespace != "mqtt" or event != "MQTT_MESSAGE":
+                continue
+
+            wildcard = kwargs.get("wildcard")
+            if wildcard is not None and not topic_matches(wildcard, topic):
+                continue
+
+            self.clock.dispatch(
+                callback, "MQTT_MESSAGE", dict(data, wildcard=wildcard), kwargs
+            )
+
+    def fire_state(self, namespace, entity_id, old, new, handles=None):
+        """Dispatch the state listeners of an entity which changed."""
+        listeners = self.state_listeners.get((namespace, entity_id), {})
+        for handle, (callback, attribute, kwargs) in list(listeners.items()):
+            if handles is not None and handle not in handles:
+                continue
+
+            if attribute == "all":
+                old_value, new_value = old, new
+            elif attribute is None:
+                old_value = old["state"] if old else None
+                new_value = new["state"] if new else None
+            else:
+                old_value = old["attributes"].get(attribute) if old else None
+                new_value = new["attributes"].get(attribute) if new else None
+
+            if old_value == new_value:
+                continue
+
+            if "new" in kwargs and kwargs["new"] != new_value:
+                continue
+
+            if "old" in kwargs and kwargs["old"] != old_value:
+                continue
+
+            self.clock.dispatch(
+                callback,
+                entity_id,
+                attribute,
+                copy.deepcopy(old_value),
+                copy.deepcopy(new_value),
+                dict(kwargs),
+            )
+
+
+def topic_matches(wildcard, topic):
+    """Check if a topic matches a MQTT subscription."""
+    wildcard_levels = wildcard.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(wildcard_levels):
+        if level == "#":
+            return True
+
+        if index >= len(topic_levels):
+            return False
+
+        if level not in ("+", topic_levels[index]):
+            return False
+
+    return len(wildcard_levels) == len(topic_levels)
+
+
+class StubAPI:
+    """The AD api, or a plugin's, bound to a namespace of the environment."""
+
+    def __init__(self, environment, namespace):
+        self.environment = environment
+        self.namespace = namespace
+        self.clock = environment.clock
+
+    def count(self, method):
+        self.environment.calls[(self.namespace, method)] += 1
+
+    # Logging
+
+    def log(self, msg, level="INFO", **kwargs):
+        self.environment.log_counts[level] += 1
+        LOGGER.log(logging.getLevelName(level), msg)
+
+    def error(self, msg, level="ERROR", **kwargs):
+        self.log(msg, level=level)
+
+    def get_main_log(self):
+        return LOGGER
+
+    # Time
+
+    def datetime(self):
+        return self.clock.now
+
+    def date(self):
+        return self.clock.now.date()
+
+    def get_now_ts(self):
+        return self.clock.now.timestamp()
+
+    def parse_time(self, time_str, name=None):
+        return datetime.time.fromisoformat(time_str)
+
+    # Scheduler
+
+    def run_in(self, callback, delay, **kwargs):
+        when = self.clock.now + datetime.timedelta(seconds=float(delay))
+        return self.clock.schedule(callback, when, 0, kwargs)
+
+    def run_at(self, callback, start, **kwargs):
+        return self.clock.schedule(callback, start, 0, kwargs)
+
+    def run_every(self, callback, start, interval, **kwargs):
+        if isinstance(start, str):
+            # "now" or "now+<seconds>"
+            delay = float(start[4:] or 0) if start.startswith("now") else 0
+            start = self.clock.now + datetime.timedelta(seconds=delay)
+
+        return self.clock.schedule(callback, start, float(interval), kwargs)
+
+    def run_daily(self, callback, start, **kwargs):
+        if isinstance(start, str):
+            start = self.parse_time(start)
+
+        when = datetime.datetime.combine(self.clock.now.date(), start)
+        if when <= self.clock.now:
+            when += datetime.timedelta(days=1)
+
+        return self.clock.schedule(callback, when, 86400, kwargs)
+
+    def cancel_timer(self, handle):
+        return self.clock.cancel(handle)
+
+    def timer_running(self, handle):
+        return handle in self.clock.handles
+
+    def submit_to_executor(self, func, *args, **kwargs):
+        future = concurrent.futures.Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as error:  # pylint: disable=broad-except
+                future.set_exception(error)
+
+        self.clock.dispatch(run)
+        return future
+
+    # State
+
+    def get_namespace(self):
+        return self.namespace
+
+    def get_state(
+        self, entity_id=None, attribute=None, default=None, copy=True, namespace=None
+    ):
+        self.count("get_state")
+        states = self.environment.states[namespace or self.namespace]
+        clone = copy_state if copy else lambda value: value
+
+        if entity_id is None:
+            return clone(states)
+
+        if "." not in entity_id:  # a domain
+            prefix = f"{entity_id}."
+            return clone(
+                {key: value for key, value in states.items() if key.startswith(prefix)}
+            )
+
+        state = states.get(entity_id)
+        if state is None:
+            return default
+
+        if attribute == "all":
+            return clone(state)
+
+        if attribute is None:
+            return state["state"]
+
+        return clone(state["attributes"].get(attribute, default))
+
+    def set_state(
+        self, entity_id, state=None, attributes=None, replace=False, namespace=None, **kwargs
+    ):
+        self.count("set_state")
+        namespace = namespace or self.namespace
+        states = self.environment.states[namespace]
+        old = states.get(entity_id)
+        now = str(self.clock.now)
+
+        new = {
+            "entity_id": entity_id,
+            "state": old["state"] if old else None,
+            "attributes": {} if replace or not old else dict(old["attributes"]),
+            "last_changed": old["last_changed"] if old else now,
+        }
+        new["attributes"].update(copy.deepcopy(attributes or {}))
+        new["attributes"].update(copy.deepcopy(kwargs))
+        if state is not None and state != new["state"]:
+            new["state"] = state
+            new["last_changed"] = now
+
+        states[entity_id] = new
+        for watcher in self.environment.watchers:
+            watcher(namespace, entity_id, old, new)
+
+        self.environment.fire_state(namespace, entity_id, old, new)
+        return copy.deepcopy(new)
+
+    def entity_exists(self, entity_id, namespace=None):
+        self.count("entity_exists")
+        return entity_id in self.environment.states[namespace or self.namespace]
+
+    def remove_entity(self, entity_id, namespace=None):
+        self.count("remove_entity")
+        self.environment.states[namespace or self.namespace].pop(entity_id, None)
+
+    def listen_state(self, callback, entity_id, attribute=None, namespace=None, **kwargs):
+        namespace = namespace or self.namespace
+        immediate = kwargs.pop("immediate", False)
+        handle = (namespace, entity_id, next(self.environment.handles))
+        self.environment.state_listeners[(namespace, entity_id)][handle] = (
+            callback,
+            attribute,
+            kwargs,
+        )
+
+        if immediate:
+            state = self.environment.states[namespace].get(entity_id)
+            if state is not None:
+                self.environment.fire_state(
+                    namespace, entity_id, None, state, handles=(handle,)
+                )
+
+        return handle
+
+    def cancel_listen_state(self, handle):
+        self.environment.state_listeners[handle[:2]].pop(handle, None)
+
+    # Events and services
+
+    def listen_event(self, callback, event=None, namespace=None, **kwargs):
+        handle = f"event_{next(self.environment.handles)}"
+        self.environment.event_listeners[handle] = (
+            namespace or self.namespace,
+            event,
+            callback,
+            kwargs,
+        )
+        return handle
+
+    def cancel_listen_event(self, handle):
+        self.environment.event_listeners.pop(handle, None)
+
+    def register_service(self, service, callback, namespace=None):
+        self.environment.services[(namespace or self.namespace, service)] = callback
+
+    def call_service(self, service, namespace=None, **kwargs):
+        namespace = namespace or self.namespace
+        callback = self.environment.services.get((namespace, service))
+        if callback is not None:
+            domain, name = service.split("/", 1)
+            self.clock.dispatch(callback, namespace, domain, name, kwargs)
+
+    # MQTT
+
+    def mqtt_subscribe(self, topic, namespace=None):
+        pass
+
+    def mqtt_unsubscribe(self, topic, namespace=None):
+        pass
+
+    def mqtt_publish(self, topic, payload=None, qos=0, retain=False, namespace=None):
+        self.environment.published[topic.split("/")[-1]] += 1
+        self.environment.published_bytes += len(payload or "")
+        for responder in self.environment.responders:
+            responder(topic, payload)
+
+        if self.environment.loopback:
+            self.clock.dispatch(self.environment.deliver, topic, payload)
+
+
+def copy_state(value):
+    return copy.deepcopy(value)
+
+
+class ADBase:
+    """Stand-in for adbase.ADBase, giving apps the apis of an environment."""
+
+    def __init__(self, args, environment=None):
+        self.args = args
+        self.environment = environment or Environment()
+        self.apis = {
+            "AD": StubAPI(self.environment, "default"),
+            "HASS": StubAPI(self.environment, "hass"),
+            "MQTT": StubAPI(self.environment, "mqtt"),
+        }
+
+    def get_ad_api(self):
+        return self.apis["AD"]
+
+    def get_plugin_api(self, plugin_name):
+        return self.apis[plugin_name]
+
+
+def install():
+    """Make ``import adbase`` give these stand-ins."""
+    sys.modules["adbase"] = sys.modules[__name__]
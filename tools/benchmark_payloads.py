@@ -0,0 +1,96 @@
+"""Microbenchmark of decoding the payloads received from the Monitor nodes.
+
+Compares the messages per second of the decoder of the app, with the JSON
+library it found and with the stdlib one, against parsing every payload as
+JSON. The mix of payloads is that of a scan, where most of the messages are
+not JSON. The app is imported against the stand-ins of
+tools/appdaemon_stub.py, so AppDaemon needn't be installed:
+
+    python tools/benchmark_payloads.py [--messages 200000]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "apps", "home_presence_app")
+)
+
+import appdaemon_stub  # noqa: E402
+
+appdaemon_stub.install()
+
+import home_presence_app  # noqa: E402
+
+DEVICE_PAYLOAD = json.dumps(
+    {
+        "id": "AA:BB:CC:DD:EE:01",
+        "confidence": "100",
+        "name": "Alice Phone",
+        "type": "KNOWN_MAC",
+        "rssi": "-65",
+        "manufacturer": "Apple Inc",
+        "retained": "false",
+        "timestamp": "Sun Oct 18 2026 12:00:00 GMT+0000 (UTC)",
+        "version": "0.2.200",
+    }
+)
+
+# (payload, share of the messages) seen during a scan
+PAYLOAD_MIX = [
+    (DEVICE_PAYLOAD, 4),
+    ("-65", 3),
+    ("ok", 1),
+    ("online", 1),
+    ("", 1),
+]
+
+
+def parse_every_payload(payload):
+    """Decode a payload the way the app did before, whatever it is."""
+    try:
+        return json.loads(payload)
+    except (TypeError, ValueError):
+        return {}
+
+
+def measure(decode, payloads):
+    """Get the messages per second decoded."""
+    start = time.perf_counter()
+    for payload in payloads:
+        decode(payload)
+
+    return len(payloads) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200000)
+    args = parser.parse_args()
+
+    mix = [payload for payload, share in PAYLOAD_MIX for _ in range(share)]
+    payloads = mix * (args.messages // len(mix))
+
+    def decode(payload):
+        return home_presence_app.HomePresenceApp.decode_payload(None, payload)
+
+    found = home_presence_app.json_loads
+    results = [("parse every payload", measure(parse_every_payload, payloads))]
+
+    home_presence_app.json_loads = json.loads
+    results.append(("app, stdlib json", measure(decode, payloads)))
+
+    home_presence_app.json_loads = found
+    if found is not json.loads:
+        results.append((f"app, {found.__module__}", measure(decode, payloads)))
+
+    baseline = results[0][1]
+    for name, rate in results:
+        print(f"{name:<22} {rate:>12,.0f} msg/s  x{rate / baseline:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+"""Benchmark of the Monitor App replaying traffic of a house, offline.
+
+The app runs against the stand-ins of tools/appdaemon_stub.py, on a virtual
+clock, so neither AppDaemon, Home Assistant nor a MQTT broker are needed.
+Traffic for N devices and M nodes is generated: the nodes coming online and
+reporting every device, scans where the devices come and go, RSSI storms
+from motion, and nodes going offline and back. For each scale it reports:
+
+- messages per second processed, in wall clock time
+- state store calls per message, over all namespaces
+- write amplification, the state writes, HASS writes and MQTT publishes per
+  message received
+- memory held by the app and the state store at the end, and its peak
+
+    python tools/benchmark_replay.py [--scale 10x3 --scale 100x10 ...]
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "apps", "home_presence_app")
+)
+
+import appdaemon_stub  # noqa: E402
+
+appdaemon_stub.install()
+
+import home_presence_app  # noqa: E402
+
+DEFAULT_SCALES = ("10x3", "100x10", "1000x20")
+
+# seconds between the messages of a burst, and between the rounds of traffic
+MESSAGE_GAP = 0.002
+ROUND_GAP = 15
+
+
+def device_payload(mac, name, location, confidence, rssi):
+    """Get a device report, as Monitor publishes it."""
+    return json.dumps(
+        {
+            "id": mac,
+            "confidence": str(confidence),
+            "name": name,
+            "type": "KNOWN_MAC",
+            "rssi": str(rssi),
+            "manufacturer": "Apple Inc",
+            "retained": "false",
+            "timestamp": "Sun Oct 18 2026 12:00:00 GMT+0000 (UTC)",
+            "version": "0.2.200",
+            "identity": location,
+        }
+    )
+
+
+def generate_traffic(devices, nodes, rounds, seed, topic="monitor"):
+    """Generate the traffic of a house, as (delay, topic, payload) messages."""
+    rng = random.Random(seed)
+    home = {mac: rng.random() < 0.5 for mac, _ in devices}
+    rssi = {(mac, node): rng.randint(-90, -40) for mac, _ in devices for node in nodes}
+
+    def report(node, mac, name):
+        confidence = 100 if home[mac] else 0
+        return (
+            MESSAGE_GAP,
+            f"{topic}/{node}/{mac}",
+            device_payload(mac, name, node, confidence, rssi[(mac, node)]),
+        )
+
+    # the nodes come online and report every device
+    for node in nodes:
+        yield MESSAGE_GAP, f"{topic}/{node}/status", "online"
+        yield MESSAGE_GAP, f"{topic}/{node}/echo", "ok"
+
+    for node in nodes:
+        for mac, name in devices:
+            yield report(node, mac, name)
+
+    for round_number in range(rounds):
+        yield ROUND_GAP, f"{topic}/{nodes[0]}/echo", "ok"
+
+        # a scan, where some of the devices come or go
+        for mac, _ in rng.sample(devices, max(1, len(devices) // 10)):
+            home[mac] = not home[mac]
+
+        scan_type = "arrive" if round_number % 2 == 0 else "depart"
+        for node in nodes:
+            yield MESSAGE_GAP, f"{topic}/{node}/{scan_type}/start", ""
+
+        for node in nodes:
+            for mac, name in rng.sample(devices, max(1, len(devices) // 5)):
+                yield report(node, mac, name)
+
+        for node in nodes:
+            yield MESSAGE_GAP, f"{topic}/{node}/{scan_type}/end", ""
+
+        if round_number % 3 == 1:
+            # motion set off RSSI scans everywhere
+            for node in nodes:
+                yield MESSAGE_GAP, f"{topic}/{node}/rssi/start", ""
+                for mac, _ in devices:
+                    if home[mac]:
+                        rssi[(mac, node)] += rng.randint(-3, 3)
+                        yield (
+                            MESSAGE_GAP,
+                            f"{topic}/{node}/{mac}/rssi",
+                            str(rssi[(mac, node)]),
+                        )
+
+                yield MESSAGE_GAP, f"{topic}/{node}/rssi/end", ""
+
+        if round_number % 5 == 4:
+            # a node drops off and comes back, reporting every device again
+            node = rng.choice(nodes)
+            yield MESSAGE_GAP, f"{topic}/{node}/status", "offline"
+            yield ROUND_GAP, f"{topic}/{node}/status", "online"
+            for mac, name in devices:
+                yield report(node, mac, name)
+
+
+def make_house(devices, nodes):
+    """Get the MACs and names of the devices, and the names of the nodes."""
+    device_list = [
+        (f"AA:BB:CC:{index >> 16 & 255:02X}:{index >> 8 & 255:02X}:{index & 255:02X}",
+         f"Device {index}")
+        for index in range(devices)
+    ]
+    node_list = [f"node_{index}" for index in range(nodes)]
+    return device_list, node_list
+
+
+def run_scale(devices, nodes, rounds, seed, measure_memory):
+    """Replay the traffic of a scale, and get its measurements."""
+    device_list, node_list = make_house(devices, nodes)
+    traffic = list(generate_traffic(device_list, node_list, rounds, seed))
+
+    gc.collect()
+    if measure_memory:
+        tracemalloc.start()
+
+    environment = appdaemon_stub.Environment()
+    clock = environment.clock
+    home_presence_app.time = appdaemon_stub.VirtualTime(clock)
+
+    app = home_presence_app.HomePresenceApp(
+        {"known_devices": [f"{mac} {name}" for mac, name in device_list]},
+        environment,
+    )
+    # the nodes online reply to the echoes of the app
+    online = set()
+
+    def reply_echo(topic, payload):
+        if topic == "monitor/echo":
+            for node in online:
+                clock.dispatch(environment.deliver, f"monitor/{node}/echo", "ok")
+
+    environment.responders.append(reply_echo)
+
+    app.initialize()
+    clock.advance(1)
+
+    environment.calls.clear()
+    environment.published.clear()
+    environment.published_bytes = 0
+
+    started = time.perf_counter()
+    for delay, topic, payload in traffic:
+        clock.advance(delay)
+        if topic.endswith("/status"):
+            node = topic.split("/")[1]
+            if payload == "online":
+                online.add(node)
+            else:
+                online.discard(node)
+
+        environment.receive(topic, payload)
+
+    # let the timers the traffic started run out
+    clock.advance(120)
+    elapsed = time.perf_counter() - started
+
+    if measure_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    else:
+        current = peak = None
+
+    messages = len(traffic)
+    calls = environment.calls
+    store_calls = sum(calls.values())
+    state_writes = sum(
+        count for (_, method), count in calls.items() if method == "set_state"
+    )
+    hass_writes = calls[("hass", "set_state")]
+    publishes = sum(environment.published.values())
+
+    app.terminate()
+    return {
+        "scale": f"{devices}x{nodes}",
+        "messages": messages,
+        "msg/s": messages / elapsed,
+        "store/msg": store_calls / messages,
+        "writes/msg": state_writes / messages,
+        "hass/msg": hass_writes / messages,
+        "publish/msg": publishes / messages,
+        "memory MB": current / 2 ** 20 if current is not None else None,
+        "peak MB": peak / 2 ** 20 if peak is not None else None,
+        "warnings": environment.log_counts["WARNING"] + environment.log_counts["ERROR"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--scale",
+        action="append",
+        help="devices x nodes to replay, may be repeated (default: %s)"
+        % ", ".join(DEFAULT_SCALES),
+    )
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="don't trace memory, which slows the replay down",
+    )
+    args = parser.parse_args()
+
+    columns = (
+        "scale",
+        "messages",
+        "msg/s",
+        "store/msg",
+        "writes/msg",
+        "hass/msg",
+        "publish/msg",
+        "memory MB",
+        "peak MB",
+        "warnings",
+    )
+    print("  ".join(f"{column:>11}" for column in columns))
+
+    for scale in args.scale or DEFAULT_SCALES:
+        devices, nodes = (int(value) for value in scale.lower().split("x"))
+        results = run_scale(devices, nodes, args.rounds, args.seed, not args.no_memory)
+
+        if not args.no_memory:
+            # the throughput without the overhead of tracing memory
+            results["msg/s"] = run_scale(
+                devices, nodes, args.rounds, args.seed, False
+            )["msg/s"]
+
+        print(
+            "  ".join(
+                f"{results[column]:>11.2f}"
+                if isinstance(results[column], float)
+                else f"{str(results[column]):>11}"
+                for column in columns
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
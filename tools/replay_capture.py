@@ -0,0 +1,186 @@
+"""Replay MQTT traffic captured by the Monitor App, offline.
+
+The app writes the messages it receives to ``capture_file`` when that is
+set. This feeds them back into the app, running against the stand-ins of
+tools/appdaemon_stub.py. The virtual clock moves by the time recorded
+between the messages, so timers fire as they did; the messages themselves
+are sent as fast as possible, or paced in real time with ``--speed``.
+
+It reports the rate and latency of processing the messages. With ``--trace``
+it prints every change of the presence sensors, with the time into the
+capture it happened, to reproduce glitches.
+
+    python tools/replay_capture.py capture.log [capture.log.1 ...]
+        [--args apps.yaml] [--app home_presence_app] [--speed 0] [--trace]
+
+Remote monitors are removed from the app's settings, so the nodes are never
+rebooted by the replay, and so are the files the app writes: the capture is
+not captured again, and the presence snapshot and profile of the app running
+at home are neither restored nor overwritten.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "apps", "home_presence_app")
+)
+
+import appdaemon_stub  # noqa: E402
+
+appdaemon_stub.install()
+
+import home_presence_app  # noqa: E402
+
+# settings of the app which reach outside of the replay
+IGNORED_ARGS = ("remote_monitors", "capture_file", "snapshot_file", "profile_file")
+
+
+def read_capture(paths):
+    """Get the (time, topic, payload) messages of capture files, in order."""
+    messages = []
+    skipped = 0
+    for path in paths:
+        with open(path) as capture:
+            for line in capture:
+                try:
+                    timestamp, topic, payload = json.loads(line)
+                except ValueError:  # a line cut short when the app stopped
+                    skipped += 1
+                    continue
+
+                messages.append((timestamp, topic, payload))
+
+    # rotated files hold the older messages, so sort them all by time
+    messages.sort(key=lambda message: message[0])
+    return messages, skipped
+
+
+def read_args(path, app_name):
+    """Get the settings of the app, from a JSON or AppDaemon YAML file."""
+    if path is None:
+        return {}
+
+    with open(path) as config_file:
+        if path.endswith(".json"):
+            config = json.load(config_file)
+        else:
+            import yaml  # pylint: disable=import-outside-toplevel
+
+            config = yaml.safe_load(config_file)
+
+    if app_name is not None:
+        config = config[app_name]
+
+    else:
+        # an apps.yaml holds the apps by name, so use the first of this module
+        apps = [
+            app
+            for app in config.values()
+            if isinstance(app, dict) and app.get("module") == "home_presence_app"
+        ]
+        if apps:
+            config = apps[0]
+
+    return {key: value for key, value in config.items() if key not in IGNORED_ARGS}
+
+
+def percentile(values, percent):
+    """Get a percentile of sorted values."""
+    if not values:
+        return 0
+
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("captures", nargs="+", help="capture files to replay")
+    parser.add_argument("--args", help="the app's settings, as JSON or apps.yaml")
+    parser.add_argument("--app", help="the name of the app in apps.yaml")
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=0,
+        help="how much faster than real time to send the messages, or 0 to send"
+        " them as fast as possible (default)",
+    )
+    parser.add_argument(
+        "--trace", action="store_true", help="print the presence changes"
+    )
+    args = parser.parse_args()
+
+    messages, skipped = read_capture(args.captures)
+    if not messages:
+        parser.error("no messages to replay")
+
+    app_args = read_args(args.args, args.app)
+    environment = appdaemon_stub.Environment(loopback=False)
+    clock = environment.clock
+    home_presence_app.time = appdaemon_stub.VirtualTime(clock)
+
+    app = home_presence_app.HomePresenceApp(app_args, environment)
+    started = clock.now
+
+    if args.trace:
+        domain = f"{app_args.get('user_device_domain', 'binary_sensor')}."
+
+        def trace(namespace, entity_id, old, new):
+            if namespace != "hass" or not entity_id.startswith(domain):
+                return
+
+            old_state = old["state"] if old else None
+            if old_state != new["state"]:
+                offset = (clock.now - started).total_seconds()
+                print(f"{offset:>10.3f}s  {entity_id}: {old_state} -> {new['state']}")
+
+        environment.watchers.append(trace)
+
+    app.initialize()
+    clock.run_pending()
+
+    latencies = []
+    replay_started = time.perf_counter()
+    previous = messages[0][0]
+    for timestamp, topic, payload in messages:
+        gap = max(0, timestamp - previous)
+        previous = timestamp
+        if args.speed > 0:
+            time.sleep(gap / args.speed)
+
+        clock.advance(gap)
+        message_started = time.perf_counter()
+        environment.receive(topic, payload)
+        latencies.append((time.perf_counter() - message_started) * 1000)
+
+    elapsed = time.perf_counter() - replay_started
+
+    # let the timers the messages started run out
+    clock.advance(120)
+    app.terminate()
+
+    latencies.sort()
+    duration = messages[-1][0] - messages[0][0]
+    print(f"messages:   {len(messages)} ({skipped} unreadable lines skipped)")
+    print(f"captured:   {duration:.1f}s, replayed in {elapsed:.2f}s")
+    print(f"rate:       {len(messages) / elapsed:.1f} msg/s")
+    print(
+        "latency ms: p50 {:.3f}  p95 {:.3f}  p99 {:.3f}  max {:.3f}".format(
+            percentile(latencies, 50),
+            percentile(latencies, 95),
+            percentile(latencies, 99),
+            latencies[-1],
+        )
+    )
+    print(
+        "warnings:   {}".format(
+            environment.log_counts["WARNING"] + environment.log_counts["ERROR"]
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()